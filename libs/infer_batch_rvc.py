@@ -1,4 +1,6 @@
 import argparse
+import functools
+import json
 import logging
 import os
 import sys
@@ -28,7 +30,9 @@ from infer.modules.vc.modules import VC
 from infer.modules.vc.pipeline import Pipeline, ah, bh, change_rms
 from infer.modules.vc.utils import *
 from scipy import signal
-from torch.multiprocessing import Pool
+from torch.multiprocessing import Pool, current_process
+from rvc_cache import ArrayCache, MemoryCache, audio_hash
+from rvc_split import find_split_points
 import warnings
 
 warnings.filterwarnings("ignore")
@@ -37,10 +41,153 @@ torch.manual_seed(114514)
 
 g_vc = None
 g_args = None
+g_indexes = {}
+g_f0_cache = None
+g_sweep = None
+g_tensors = {}
 
 # My modified methods
 
 
+def load_vectors(index, file_index):
+    """
+    Returns vectors of the index memory-mapped from a .npy next to it,
+    so that workers share them instead of each holding a copy.
+    """
+    stat = os.stat(file_index)
+    path = "%s.%d-%d.vectors.npy" % (
+        os.path.splitext(file_index)[0],
+        stat.st_size,
+        stat.st_mtime,
+    )
+    if not os.path.exists(path):
+        # Other workers may be writing it too
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.save(f, index.reconstruct_n(0, index.ntotal))
+        os.replace(tmp_path, path)
+
+    return np.load(path, mmap_mode="r")
+
+
+def load_index(file_index, mmap=False):
+    """Loads the index and its vectors only once per worker."""
+    if file_index not in g_indexes:
+        try:
+            index = faiss.read_index(file_index, faiss.IO_FLAG_MMAP if mmap else 0)
+            if mmap:
+                big_npy = load_vectors(index, file_index)
+            else:
+                big_npy = index.reconstruct_n(0, index.ntotal)
+        except:
+            traceback.print_exc()
+            index = big_npy = None
+        g_indexes[file_index] = (index, big_npy)
+
+    return g_indexes[file_index]
+
+
+class CachedHubert:
+    """
+    HuBERT that saves its features of every audio it sees.
+    The features only depend on the audio and the precision of HuBERT,
+    so they are shared by all voice models.
+    """
+
+    def __init__(self, model, cache: ArrayCache):
+        self.model = model
+        self.cache = cache
+        # Quantized HuBERT of --cpu_profile gives other features
+        self.quantized = any(
+            isinstance(module, torch.ao.nn.quantized.dynamic.Linear)
+            for module in model.modules()
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def _get_key(self, source, output_layer):
+        return audio_hash(
+            source.cpu().numpy(),
+            "hubert",
+            output_layer,
+            "int8" if self.quantized else source.dtype,
+        )
+
+    def load(self, source, output_layer):
+        """Returns cached features of given audio, or None."""
+        feats = self.cache.load(self._get_key(source, output_layer))
+        if feats is None:
+            return None
+        return torch.from_numpy(feats).to(source.device, source.dtype)
+
+    def save(self, source, output_layer, feats):
+        self.cache.save(self._get_key(source, output_layer), feats.cpu().numpy())
+
+    def extract_features(self, source, padding_mask=None, output_layer=None):
+        feats = self.load(source, output_layer)
+        if feats is None:
+            feats = self.model.extract_features(
+                source=source, padding_mask=padding_mask, output_layer=output_layer
+            )[0]
+            self.save(source, output_layer, feats)
+        return feats, None
+
+
+def quantize(model):
+    """Dynamic int8 quantization of the layers that support it, CPU only."""
+    return torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+
+
+def get_sid(sid, count, device):
+    """Returns speaker ids for a batch, created only once per worker."""
+    key = ("sid", sid, count, str(device))
+    if key not in g_tensors:
+        g_tensors[key] = torch.full((count,), sid, device=device).long()
+    return g_tensors[key]
+
+
+def get_buffer(name, shape, dtype, fill):
+    """
+    Returns a CPU tensor of given shape filled with `fill`.
+    Its memory is reused by later calls with the same name.
+    """
+    buffer = g_tensors.get(name)
+    if (
+        buffer is None
+        or buffer.dtype != dtype
+        or any(size < wanted for size, wanted in zip(buffer.shape, shape))
+    ):
+        buffer = torch.empty(shape, dtype=dtype)
+        g_tensors[name] = buffer
+
+    buffer = buffer[tuple(slice(0, wanted) for wanted in shape)]
+    buffer.fill_(fill)
+    return buffer
+
+
+def get_hubert(config):
+    """Loads HuBERT, with the feature cache if enabled."""
+    model = load_hubert(config)
+    if g_args is not None and g_args.cpu_profile:
+        model = quantize(model)
+    return wrap_hubert(model)
+
+
+def wrap_hubert(model):
+    """Adds the feature cache the current arguments want to HuBERT."""
+    if isinstance(model, CachedHubert):
+        model = model.model
+
+    if g_args is not None and g_args.feature_cache:
+        model = CachedHubert(model, ArrayCache(g_args.feature_cache, np.float16))
+    elif g_args is not None and g_args.sweep:
+        model = CachedHubert(model, MemoryCache())
+    return model
+
+
 def get_f0(
     self,
     input_audio_path,
@@ -58,16 +205,25 @@ def get_f0(
     f0_mel_min = 1127 * np.log(1 + f0_min / 700)
     f0_mel_max = 1127 * np.log(1 + f0_max / 700)
 
-    if not hasattr(self, "model_rmvpe"):
-        from infer.lib.rmvpe import RMVPE
+    # The raw curve only depends on the audio, the rest is applied every time
+    key = audio_hash(x, "rmvpe", 0.03)
+    f0 = g_f0_cache.load(key) if g_f0_cache is not None else None
+    if f0 is None:
+        if not hasattr(self, "model_rmvpe"):
+            from infer.lib.rmvpe import RMVPE
 
-        logger.info("Loading rmvpe model,%s" % "%s/rmvpe.pt" % os.environ["rmvpe_root"])
-        self.model_rmvpe = RMVPE(
-            "%s/rmvpe.pt" % os.environ["rmvpe_root"],
-            is_half=self.is_half,
-            device=self.device,
-        )
-    f0 = self.model_rmvpe.infer_from_audio(x, thred=0.03)
+            logger.info(
+                "Loading rmvpe model,%s" % "%s/rmvpe.pt" % os.environ["rmvpe_root"]
+            )
+            self.model_rmvpe = RMVPE(
+                "%s/rmvpe.pt" % os.environ["rmvpe_root"],
+                is_half=self.is_half,
+                device=self.device,
+            )
+        f0 = self.model_rmvpe.infer_from_audio(x, thred=0.03)
+        if g_f0_cache is not None:
+            g_f0_cache.save(key, f0)
+    f0 = f0.astype(np.float32)
 
     if filter_radius > 2:
         f0 = signal.medfilt(f0, filter_radius)
@@ -131,31 +287,16 @@ def pipeline(
         and os.path.exists(file_index)
         and index_rate != 0
     ):
-        try:
-            index = faiss.read_index(file_index)
-            # big_npy = np.load(file_big_npy)
-            big_npy = index.reconstruct_n(0, index.ntotal)
-        except:
-            traceback.print_exc()
-            index = big_npy = None
+        index, big_npy = load_index(
+            file_index, g_args is not None and g_args.index_mmap
+        )
     else:
         index = big_npy = None
     audio = signal.filtfilt(bh, ah, audio)
     audio_pad = np.pad(audio, (self.window // 2, self.window // 2), mode="reflect")
     opt_ts = []
     if audio_pad.shape[0] > self.t_max:
-        audio_sum = np.zeros_like(audio)
-        for i in range(self.window):
-            audio_sum += np.abs(audio_pad[i : i - self.window])
-        for t in range(self.t_center, audio.shape[0], self.t_center):
-            opt_ts.append(
-                t
-                - self.t_query
-                + np.where(
-                    audio_sum[t - self.t_query : t + self.t_query]
-                    == audio_sum[t - self.t_query : t + self.t_query].min()
-                )[0][0]
-            )
+        opt_ts = find_split_points(audio_pad, self.window, self.t_center, self.t_query)
     s = 0
     audio_opt = []
     t = None
@@ -174,7 +315,7 @@ def pipeline(
             inp_f0 = np.array(inp_f0, dtype="float32")
         except:
             traceback.print_exc()
-    sid = torch.tensor(sid, device=self.device).unsqueeze(0).long()
+    sid = get_sid(sid, 1, self.device)
     pitch, pitchf = None, None
     if if_f0 == 1:
         pitch, pitchf = get_f0(
@@ -310,20 +451,9 @@ def vc_single(
         times = [0, 0, 0]
 
         if self.hubert_model is None:
-            self.hubert_model = load_hubert(self.config)
-
-        file_index = (
-            (
-                file_index.strip(" ")
-                .strip('"')
-                .strip("\n")
-                .strip('"')
-                .strip(" ")
-                .replace("trained", "added")
-            )
-            if file_index != ""
-            else file_index2
-        )  # 防止小白写错，自动帮他替换掉
+            self.hubert_model = get_hubert(self.config)
+
+        file_index = clean_index_path(file_index, file_index2)
 
         audio_opt = pipeline(
             self.pipeline,
@@ -367,10 +497,194 @@ def vc_single(
         return info, (None, None)
 
 
+def clean_index_path(file_index, file_index2=""):
+    return (
+        (
+            file_index.strip(" ")
+            .strip('"')
+            .strip("\n")
+            .strip('"')
+            .strip(" ")
+            .replace("trained", "added")
+        )
+        if file_index != ""
+        else file_index2
+    )  # 防止小白写错，自动帮他替换掉
+
+
+# Batched inference of short files
+
+
+def hubert_frames(length):
+    """Number of HuBERT features for given number of samples."""
+    for kernel, stride in ((10, 5), (3, 2), (3, 2), (3, 2), (3, 2), (2, 2), (2, 2)):
+        length = (length - kernel) // stride + 1
+    return length
+
+
+def prepare_audio(vc, input_audio_path, args):
+    """
+    Loads the audio and extracts its pitch like `vc_single` and `pipeline` do.
+    Returns None for audio that `pipeline` would split.
+    """
+    self = vc.pipeline
+
+    audio = load_audio(input_audio_path, 16000)
+    audio_max = np.abs(audio).max() / 0.95
+    if audio_max > 1:
+        audio /= audio_max
+    audio = signal.filtfilt(bh, ah, audio)
+
+    if audio.shape[0] + self.window // 2 * 2 > self.t_max:
+        return None
+
+    audio_pad = np.pad(audio, (self.t_pad, self.t_pad), mode="reflect")
+    p_len = audio_pad.shape[0] // self.window
+    pitch, pitchf = None, None
+    if vc.if_f0 == 1:
+        pitch, pitchf = get_f0(
+            self,
+            input_audio_path,
+            audio_pad,
+            p_len,
+            int(args.f0up_key),
+            args.f0_contrast,
+            args.f0method,
+            args.filter_radius,
+        )
+        pitch = pitch[:p_len]
+        pitchf = pitchf[:p_len].astype(np.float32)
+
+    return audio, audio_pad, pitch, pitchf
+
+
+def vc_batch(
+    self, model, net_g, sid, items, index, big_npy, index_rate, version, protect
+):
+    """
+    `Pipeline.vc` over several prepared audios at once.
+    HuBERT and the synthesizer run once on the padded batch, the index search
+    runs per audio, returns the converted audio of each.
+    """
+    dtype = torch.float16 if self.is_half else torch.float32
+    lengths = [audio_pad.shape[0] for _, audio_pad, _, _ in items]
+
+    source = get_buffer("source", (len(items), max(lengths)), dtype, 0)
+    padding_mask = get_buffer("padding_mask", (len(items), max(lengths)), torch.bool, 1)
+    for i, (_, audio_pad, _, _) in enumerate(items):
+        source[i, : lengths[i]] = torch.from_numpy(audio_pad)
+        padding_mask[i, : lengths[i]] = False
+
+    # Only run HuBERT on audio that isn't cached
+    output_layer = 9 if version == "v1" else 12
+    cached = isinstance(model, CachedHubert)
+    feats = [None] * len(items)
+    if cached:
+        for i in range(len(items)):
+            feats[i] = model.load(source[i : i + 1, : lengths[i]], output_layer)
+
+    missing = [i for i, feat in enumerate(feats) if feat is None]
+    if len(missing) > 0:
+        length = max(lengths[i] for i in missing)
+        with torch.no_grad():
+            logits = getattr(model, "model", model).extract_features(
+                source=source[missing, :length].to(self.device),
+                padding_mask=padding_mask[missing, :length].to(self.device),
+                output_layer=output_layer,
+            )
+        for j, i in enumerate(missing):
+            feats[i] = logits[0][j : j + 1, : hubert_frames(lengths[i])]
+            if cached:
+                model.save(source[i : i + 1, : lengths[i]], output_layer, feats[i])
+
+    has_pitch = items[0][2] is not None
+    phones = []
+    pitches = []
+    p_lens = []
+    for i, (_, audio_pad, pitch, pitchf) in enumerate(items):
+        feat = feats[i].to(self.device)
+        if version == "v1":
+            with torch.no_grad():
+                feat = model.final_proj(feat)
+        feat0 = feat.clone()
+
+        if index is not None and big_npy is not None and index_rate != 0:
+            npy = feat[0].cpu().numpy().astype("float32")
+            score, ix = index.search(npy, k=8)
+            weight = np.square(1 / score)
+            weight /= weight.sum(axis=1, keepdims=True)
+            npy = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
+            feat = (
+                torch.from_numpy(npy).to(self.device, feat.dtype).unsqueeze(0)
+                * index_rate
+                + (1 - index_rate) * feat
+            )
+
+        feat = F.interpolate(feat.permute(0, 2, 1), scale_factor=2).permute(0, 2, 1)
+        p_len = min(audio_pad.shape[0] // self.window, feat.shape[1])
+        feat = feat[0, :p_len]
+
+        if has_pitch:
+            pitch = torch.tensor(pitch[:p_len], device=self.device).long()
+            pitchf = torch.tensor(pitchf[:p_len], device=self.device).float()
+            if protect < 0.5:
+                feat0 = F.interpolate(feat0.permute(0, 2, 1), scale_factor=2).permute(
+                    0, 2, 1
+                )[0, :p_len]
+                pitchff = pitchf.clone()
+                pitchff[pitchf > 0] = 1
+                pitchff[pitchf < 1] = protect
+                pitchff = pitchff.unsqueeze(-1)
+                feat = (feat * pitchff + feat0 * (1 - pitchff)).to(feat0.dtype)
+            pitches.append((pitch, pitchf))
+
+        phones.append(feat)
+        p_lens.append(p_len)
+
+    phone = torch.nn.utils.rnn.pad_sequence(phones, batch_first=True)
+    phone_lengths = torch.tensor(p_lens, device=self.device).long()
+    sid = get_sid(sid, len(items), self.device)
+
+    with torch.no_grad():
+        if has_pitch:
+            pitch = torch.nn.utils.rnn.pad_sequence(
+                [pitch for pitch, _ in pitches], batch_first=True
+            )
+            pitchf = torch.nn.utils.rnn.pad_sequence(
+                [pitchf for _, pitchf in pitches], batch_first=True
+            )
+            audio1 = net_g.infer(phone, phone_lengths, pitch, pitchf, sid)[0]
+        else:
+            audio1 = net_g.infer(phone, phone_lengths, sid)[0]
+        audio1 = audio1[:, 0].data.cpu().float().numpy()
+
+    # Every frame makes the same number of samples, cut off the padding
+    frame = audio1.shape[1] // phone.shape[1]
+    return [
+        audio1[i, : p_len * frame][self.t_pad_tgt : -self.t_pad_tgt]
+        for i, p_len in enumerate(p_lens)
+    ]
+
+
+def finish_audio(vc, audio, audio_opt, resample_sr, rms_mix_rate):
+    """The end of `pipeline`, returns sample rate and the audio in int16."""
+    tgt_sr = vc.tgt_sr
+    if rms_mix_rate != 1:
+        audio_opt = change_rms(audio, 16000, audio_opt, tgt_sr, rms_mix_rate)
+    if resample_sr >= 16000 and tgt_sr != resample_sr:
+        audio_opt = librosa.resample(audio_opt, orig_sr=tgt_sr, target_sr=resample_sr)
+        tgt_sr = resample_sr
+    audio_max = np.abs(audio_opt).max() / 0.99
+    max_int16 = 32768
+    if audio_max > 1:
+        max_int16 /= audio_max
+    return tgt_sr, (audio_opt * max_int16).astype(np.int16)
+
+
 # The script itself
 
 
-def arg_parse() -> tuple:
+def arg_parse(argv=None) -> tuple:
     parser = argparse.ArgumentParser()
     parser.add_argument("--f0up_key", type=int, default=0)
     parser.add_argument("--input_path", type=str, help="input path")
@@ -398,31 +712,159 @@ def arg_parse() -> tuple:
     parser.add_argument(
         "--batchsize", type=int, default=1, help="how many RVC processes to spawn"
     )
+    parser.add_argument(
+        "--num_threads", type=int, help="torch intra-op threads per process"
+    )
+    parser.add_argument(
+        "--interop_threads", type=int, help="torch inter-op threads per process"
+    )
     parser.add_argument(
         "--suffix",
         default=".wav",
         help="What suffix must the file have to be processed",
     )
+    parser.add_argument(
+        "--infer_batch",
+        type=int,
+        default=1,
+        help="how many short files to convert together in one process",
+    )
+    parser.add_argument(
+        "--benchmark_batch",
+        type=int,
+        help="revoice this many files one by one and in batches, compare the speed and exit",
+    )
+    parser.add_argument(
+        "--feature_cache",
+        type=str,
+        help="folder to cache HuBERT features of the input audio in",
+    )
+    parser.add_argument(
+        "--stdin_feed",
+        type=lambda value: value == "True",
+        default=False,
+        help="read files to process from stdin as they come instead of the input path",
+    )
+    parser.add_argument(
+        "--cpu_profile",
+        type=lambda value: value == "True",
+        default=False,
+        help="run on CPU with quantized models, inference mode and pinned threads",
+    )
+    parser.add_argument(
+        "--sweep",
+        type=str,
+        help="json list of settings to revoice every file with, each into its own folder",
+    )
+    parser.add_argument(
+        "--f0_cache",
+        type=str,
+        help="folder to cache raw pitch curves of the input audio in",
+    )
+    parser.add_argument(
+        "--index_mmap",
+        type=lambda value: value == "True",
+        default=False,
+        help="memory-map the index and its vectors, cached in a .npy next to it, instead of reading them whole",
+    )
+    parser.add_argument(
+        "--benchmark_index",
+        type=int,
+        help="measure loading the index this many times with and without cache and exit",
+    )
+    parser.add_argument(
+        "--file_list",
+        type=str,
+        help="json list of files relative to input path to process instead of all",
+    )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     sys.argv = sys.argv[:1]
 
     return args
 
 
 def init_worker(p_args):
-    global g_vc, g_args
+    global g_vc
+    setup_args(p_args)
+    setup_threads(p_args)
+    g_vc = load_vc(p_args)
+
+
+def setup_args(p_args):
+    """Sets the arguments and caches they want for following files."""
+    global g_args, g_f0_cache, g_sweep
     g_args = p_args
+    g_f0_cache = None
+    g_sweep = None
+
+    if g_args.f0_cache:
+        g_f0_cache = ArrayCache(g_args.f0_cache, np.float32)
+
+    if g_args.sweep:
+        g_sweep = load_sweep(g_args.sweep)
+        if g_f0_cache is None:
+            g_f0_cache = MemoryCache()
+
+
+def setup_threads(p_args):
+    num_threads = p_args.num_threads
+    if p_args.cpu_profile:
+        num_threads = num_threads or max(1, os.cpu_count() // p_args.batchsize)
+        pin_threads(num_threads)
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if p_args.interop_threads:
+        torch.set_num_interop_threads(p_args.interop_threads)
+
 
+def load_vc(p_args):
+    """Loads the voice model, HuBERT and RMVPE are loaded on first use."""
     config = Config()
-    config.device = g_args.device if g_args.device else config.device
-    config.is_half = g_args.is_half if g_args.is_half else config.is_half
+    config.device = p_args.device if p_args.device else config.device
+    config.is_half = p_args.is_half if p_args.is_half else config.is_half
+    if p_args.cpu_profile:
+        config.device = "cpu"
+        config.is_half = False
+
+    vc = VC(config)
+    vc.get_vc(p_args.model_name)
+
+    if p_args.cpu_profile:
+        vc.net_g = quantize(vc.net_g)
+
+    return vc
+
+
+def pin_threads(num_threads):
+    """Pins this worker to its own cores, so workers don't fight over them."""
+    if not hasattr(os, "sched_setaffinity"):
+        return
+
+    cores = sorted(os.sched_getaffinity(0))
+    groups = max(1, len(cores) // num_threads)
+    identity = current_process()._identity
+    group = (identity[0] - 1) % groups if len(identity) > 0 else 0
+    os.sched_setaffinity(0, cores[group * num_threads : (group + 1) * num_threads])
+
 
-    g_vc = VC(config)
-    g_vc.get_vc(g_args.model_name)
+def profiled(func):
+    """Runs the worker in `torch.inference_mode` with the CPU profile."""
 
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if g_args.cpu_profile:
+            with torch.inference_mode():
+                return func(*args, **kwargs)
+        return func(*args, **kwargs)
 
+    return wrapper
+
+
+@profiled
 def run_worker(file_path):
+    """Revoices the file, returns its length in seconds."""
     args = g_args
     vc = g_vc
 
@@ -444,9 +886,322 @@ def run_worker(file_path):
     )
     if wav_opt[1] is None:
         tq.tqdm.write(f"FILE FAILED: {file_path}")
-        return
+        return 0
     out_path = os.path.join(args.opt_path, file_path)
     wavfile.write(out_path, wav_opt[0], wav_opt[1])
+    return len(wav_opt[1]) / wav_opt[0]
+
+
+@profiled
+def run_worker_batch(file_paths):
+    """Revoices several files at once, long files are revoiced one by one."""
+    args = g_args
+    vc = g_vc
+
+    if vc.hubert_model is None:
+        vc.hubert_model = get_hubert(vc.config)
+
+    batch = []
+    seconds = 0
+    for file_path in file_paths:
+        try:
+            item = prepare_audio(vc, os.path.join(args.input_path, file_path), args)
+        except:
+            traceback.print_exc()
+            tq.tqdm.write(f"FILE FAILED: {file_path}")
+            continue
+
+        if item is None:
+            seconds += run_worker(file_path)
+        else:
+            batch.append((file_path, item))
+
+    if len(batch) == 0:
+        return len(file_paths), seconds
+
+    file_index = clean_index_path(args.index_path or "")
+    index = big_npy = None
+    if file_index != "" and os.path.exists(file_index) and args.index_rate != 0:
+        index, big_npy = load_index(file_index, args.index_mmap)
+
+    try:
+        outputs = vc_batch(
+            vc.pipeline,
+            vc.hubert_model,
+            vc.net_g,
+            0,
+            [item for _, item in batch],
+            index,
+            big_npy,
+            args.index_rate,
+            vc.version,
+            args.protect,
+        )
+    except:
+        traceback.print_exc()
+        tq.tqdm.write("BATCH FAILED, revoicing its files one by one")
+        for file_path, _ in batch:
+            seconds += run_worker(file_path)
+        return len(file_paths), seconds
+
+    for (file_path, item), audio_opt in zip(batch, outputs):
+        out_path = os.path.join(args.opt_path, file_path)
+        sr, wav = finish_audio(
+            vc, item[0], audio_opt, args.resample_sr, args.rms_mix_rate
+        )
+        wavfile.write(out_path, sr, wav)
+        seconds += len(wav) / sr
+
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    return len(file_paths), seconds
+
+
+def get_sweep_folder(settings: dict):
+    return "_".join(f"{key}={value}" for key, value in settings.items())
+
+
+def load_sweep(path):
+    """Returns output folders and settings of the sweep."""
+    with open(path, "r", encoding="utf-8") as f:
+        return [(get_sweep_folder(settings), settings) for settings in json.load(f)]
+
+
+@profiled
+def run_worker_sweep(file_path):
+    """
+    Revoices the file with every settings of the sweep.
+    The audio is loaded once, HuBERT features and pitch are reused between them.
+    """
+    args = g_args
+    vc = g_vc
+    input_audio_path = os.path.join(args.input_path, file_path)
+
+    if vc.hubert_model is None:
+        vc.hubert_model = get_hubert(vc.config)
+
+    try:
+        audio = load_audio(input_audio_path, 16000)
+        audio_max = np.abs(audio).max() / 0.95
+        if audio_max > 1:
+            audio /= audio_max
+        file_index = clean_index_path(args.index_path or "")
+
+        for folder, settings in g_sweep:
+            run = argparse.Namespace(**{**vars(args), **settings})
+            audio_opt = pipeline(
+                vc.pipeline,
+                vc.hubert_model,
+                vc.net_g,
+                0,
+                audio,
+                input_audio_path,
+                [0, 0, 0],
+                int(run.f0up_key),
+                run.f0_contrast,
+                run.f0method,
+                file_index,
+                run.index_rate,
+                vc.if_f0,
+                run.filter_radius,
+                vc.tgt_sr,
+                run.resample_sr,
+                run.rms_mix_rate,
+                vc.version,
+                run.protect,
+            )
+            tgt_sr = (
+                run.resample_sr if vc.tgt_sr != run.resample_sr >= 16000 else vc.tgt_sr
+            )
+
+            out_path = os.path.join(args.opt_path, folder, file_path)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            wavfile.write(out_path, tgt_sr, audio_opt)
+    except:
+        traceback.print_exc()
+        tq.tqdm.write(f"FILE FAILED: {file_path}")
+    finally:
+        # Nothing else will use them
+        for cache in (g_f0_cache, getattr(vc.hubert_model, "cache", None)):
+            if isinstance(cache, MemoryCache):
+                cache.clear()
+
+
+def write_sweep_index(args, audios):
+    """Writes `sweep.json` listing the files and folders of all settings."""
+    sweep = load_sweep(args.sweep)
+    os.makedirs(args.opt_path, exist_ok=True)
+    with open(os.path.join(args.opt_path, "sweep.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "files": audios,
+                "runs": [
+                    {"folder": folder, "settings": settings}
+                    for folder, settings in sweep
+                ],
+            },
+            f,
+            indent=4,
+        )
+    return sweep
+
+
+def run_sweep(args, audios):
+    """Revoices the files with every settings of the sweep."""
+    sweep = write_sweep_index(args, audios)
+    pbar = tq.tqdm(
+        desc=f"Sweeping {len(sweep)} settings", total=len(audios), unit="file"
+    )
+    with Pool(args.batchsize, init_worker, (args,)) as pool:
+        for _ in pool.imap_unordered(run_worker_sweep, audios):
+            pbar.update(1)
+
+
+def make_batches(args, audios):
+    """Groups files of similar length together."""
+    audios = sorted(
+        audios, key=lambda file: os.path.getsize(os.path.join(args.input_path, file))
+    )
+    return [
+        audios[i : i + args.infer_batch]
+        for i in range(0, len(audios), args.infer_batch)
+    ]
+
+
+def find_inputs(args):
+    if args.file_list:
+        with open(args.file_list, "r", encoding="utf-8") as f:
+            yield from json.load(f)
+        return
+
+    for root, _dirs, files in os.walk(args.input_path):
+        for file in files:
+            if file.endswith(args.suffix):
+                yield os.path.join(root[len(args.input_path) + 1 :], file)
+
+
+def read_feed(args):
+    """Yields files sent on stdin as they come, until it's closed."""
+    for line in sys.stdin:
+        file_path = line.strip()
+        if file_path == "":
+            continue
+
+        out_path = os.path.join(args.opt_path, file_path)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+        if args.overwrite or not os.path.exists(out_path):
+            yield file_path
+
+
+def feed_batches(args, audios):
+    """Groups files in the order they come, they can't be sorted by length."""
+    batch = []
+    for file_path in audios:
+        batch.append(file_path)
+        if len(batch) == args.infer_batch:
+            yield batch
+            batch = []
+
+    if len(batch) > 0:
+        yield batch
+
+
+def collect_inputs(args):
+    """Returns files to revoice and prepares their output folders."""
+    audios = []
+    for file_path in find_inputs(args):
+        out_path = os.path.join(args.opt_path, file_path)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+        if args.overwrite or not os.path.exists(out_path):
+            audios.append(file_path)
+    return audios
+
+
+def benchmark_index(args):
+    """Compares loading the index for every file with loading it once per worker."""
+    global g_args
+    g_args = args
+    runs = args.benchmark_index
+
+    start = ttime()
+    for _ in range(runs):
+        index = faiss.read_index(args.index_path)
+        index.reconstruct_n(0, index.ntotal)
+    uncached = (ttime() - start) / runs
+
+    start = ttime()
+    load_index(args.index_path, args.index_mmap)
+    first = ttime() - start
+
+    start = ttime()
+    for _ in range(runs):
+        load_index(args.index_path, args.index_mmap)
+    cached = (ttime() - start) / runs
+
+    tq.tqdm.write(
+        "Index load per file: %.3fs uncached, %.6fs cached (first load %.3fs%s),"
+        " saving %.3fs per file"
+        % (
+            uncached,
+            cached,
+            first,
+            " memory-mapped" if args.index_mmap else "",
+            uncached - cached,
+        )
+    )
+
+
+def benchmark_batch(args, audios):
+    """Compares the speed of revoicing files one by one and in batches."""
+    init_worker(args)
+    audios = audios[: args.benchmark_batch]
+    if len(audios) == 0:
+        tq.tqdm.write("No files to benchmark.")
+        return
+
+    # Warm up, loads the models
+    run_worker_batch(audios[:1])
+
+    start = ttime()
+    for file_path in audios:
+        run_worker(file_path)
+    single = len(audios) / (ttime() - start)
+
+    start = ttime()
+    for batch in make_batches(args, audios):
+        run_worker_batch(batch)
+    batched = len(audios) / (ttime() - start)
+
+    tq.tqdm.write(
+        "%d files: one by one %.2f files/s, in batches of %d %.2f files/s, %.2fx faster"
+        % (len(audios), single, args.infer_batch, batched, batched / single)
+    )
+
+
+def report_speed(args, seconds, elapsed):
+    """
+    Prints the real-time factor, time spent per second of audio.
+    The time includes loading of the models.
+    """
+    if seconds == 0:
+        return
+
+    rtf = elapsed / seconds
+    tq.tqdm.write(
+        "Revoiced %.1f min of audio in %.1f min: real-time factor %.3f (%.1fx real time),"
+        " %.3f per process%s"
+        % (
+            seconds / 60,
+            elapsed / 60,
+            rtf,
+            1 / rtf,
+            rtf * args.batchsize,
+            " with the CPU profile" if args.cpu_profile else "",
+        )
+    )
 
 
 def main():
@@ -456,25 +1211,42 @@ def main():
     if args.index_path and not os.path.exists(args.index_path):
         tq.tqdm.write("WARNING: Index file does not exist!!")
 
-    # Collect tasks
-    audios = []
-    for root, _dirs, files in os.walk(args.input_path):
-        for file in files:
-            if not file.endswith(args.suffix):
-                continue
+    if args.benchmark_index:
+        benchmark_index(args)
+        return
 
-            file_path = os.path.join(root[len(args.input_path) + 1 :], file)
-            out_path = os.path.join(args.opt_path, file_path)
-            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    if args.sweep:
+        run_sweep(args, list(find_inputs(args)))
+        return
+
+    if args.stdin_feed:
+        audios = read_feed(args)
+        batches = feed_batches(args, audios)
+        total = None
+    else:
+        audios = collect_inputs(args)
+        batches = make_batches(args, audios)
+        total = len(audios)
 
-            if args.overwrite or not os.path.exists(out_path):
-                audios.append(file_path)
+        if args.benchmark_batch:
+            benchmark_batch(args, audios)
+            return
 
-    pbar = tq.tqdm(desc="Revoicing", total=len(audios), unit="file")
+    pbar = tq.tqdm(desc="Revoicing", total=total, unit="file")
+    seconds = 0
+    start = ttime()
 
     with Pool(args.batchsize, init_worker, (args,)) as pool:
-        for _ in pool.imap_unordered(run_worker, audios):
-            pbar.update(1)
+        if args.infer_batch > 1:
+            for count, audio_seconds in pool.imap_unordered(run_worker_batch, batches):
+                pbar.update(count)
+                seconds += audio_seconds
+        else:
+            for audio_seconds in pool.imap_unordered(run_worker, audios):
+                pbar.update(1)
+                seconds += audio_seconds
+
+    report_speed(args, seconds, ttime() - start)
 
 
 if __name__ == "__main__":
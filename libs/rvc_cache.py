@@ -0,0 +1,76 @@
+"""
+On-disk caches of what RVC computes from the source audio alone,
+so that re-runs with another voice model or settings can skip it.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+# Bump when the cached data changes meaning
+CACHE_VERSION = 1
+
+
+def audio_hash(audio: np.ndarray, *extra):
+    """Returns sha1 of the audio samples and given extra values."""
+    sha1 = hashlib.sha1(np.ascontiguousarray(audio).tobytes())
+    for value in (CACHE_VERSION, *extra):
+        sha1.update(str(value).encode())
+    return sha1.hexdigest()
+
+
+class ArrayCache:
+    """Stores numpy arrays in a folder under their keys."""
+
+    def __init__(self, path: str, dtype=None):
+        self.path = path
+        self.dtype = dtype
+        self.hits = 0
+        self.misses = 0
+
+    def _get_path(self, key: str):
+        return os.path.join(self.path, key[:2], key + ".npy")
+
+    def load(self, key: str, mmap=False):
+        """Returns the array saved under given key, or None."""
+        try:
+            array = np.load(self._get_path(key), mmap_mode="r" if mmap else None)
+        except (IOError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return array
+
+    def save(self, key: str, array: np.ndarray):
+        """Saves the array, safe to call from several processes at once."""
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array if self.dtype is None else array.astype(self.dtype))
+        os.replace(tmp_path, path)
+
+
+class MemoryCache(ArrayCache):
+    """Keeps arrays in memory, for reusing them within one process."""
+
+    def __init__(self):
+        super().__init__(None)
+        self.arrays = {}
+
+    def load(self, key: str, mmap=False):
+        array = self.arrays.get(key)
+        if array is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return array
+
+    def save(self, key: str, array: np.ndarray):
+        self.arrays[key] = np.array(array)
+
+    def clear(self):
+        self.arrays.clear()
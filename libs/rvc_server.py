@@ -0,0 +1,258 @@
+"""
+Keeps RVC processes with loaded models running and revoices folders on request,
+so that revoicing doesn't load torch and the models again every time.
+Requests are json lines with arguments of `infer_batch_rvc.py`, progress is sent back.
+Listens on a unix socket, or on localhost where those aren't supported.
+"""
+
+import argparse
+import gc
+import json
+import os
+import socket
+import socketserver
+import sys
+import traceback
+from collections import OrderedDict
+from time import time as ttime
+
+import infer_batch_rvc as infer
+import torch
+import tqdm as tq
+from dotenv import load_dotenv
+from torch.multiprocessing import Pool
+
+g_models = OrderedDict()
+g_max_models = 2
+g_job = None
+
+
+# Worker side
+
+
+def init_server_worker(server_args):
+    global g_max_models
+    g_max_models = server_args.models
+    infer.setup_threads(server_args)
+
+
+def get_model_key(args):
+    return (args.model_name, args.device, args.is_half, args.cpu_profile)
+
+
+def use_job(args):
+    """Switches the worker to the job's arguments and voice model."""
+    global g_job
+    if g_job is not None and vars(g_job) == vars(args):
+        return
+    g_job = args
+    infer.setup_args(args)
+
+    key = get_model_key(args)
+    if key in g_models:
+        g_models.move_to_end(key)
+    else:
+        vc = infer.load_vc(args)
+
+        # HuBERT and RMVPE don't depend on the voice model
+        for other_key, other in g_models.items():
+            if other_key[1:] == key[1:]:
+                vc.hubert_model = other.hubert_model
+                if hasattr(other.pipeline, "model_rmvpe"):
+                    vc.pipeline.model_rmvpe = other.pipeline.model_rmvpe
+                break
+
+        g_models[key] = vc
+        while len(g_models) > g_max_models:
+            g_models.popitem(last=False)
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    vc = g_models[key]
+    if vc.hubert_model is not None:
+        vc.hubert_model = infer.wrap_hubert(vc.hubert_model)
+    infer.g_vc = vc
+
+
+def run_file(task):
+    args, file_path = task
+    use_job(args)
+    return 1, infer.run_worker(file_path)
+
+
+def run_batch(task):
+    args, file_paths = task
+    use_job(args)
+    return infer.run_worker_batch(file_paths)
+
+
+def run_sweep(task):
+    args, file_path = task
+    use_job(args)
+    infer.run_worker_sweep(file_path)
+    return 1, 0
+
+
+# Server side
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Runs jobs of one connection, one at a time."""
+
+    def send(self, **message):
+        self.wfile.write((json.dumps(message) + "\n").encode())
+        self.wfile.flush()
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self.send(error="Invalid request.")
+                continue
+
+            if request.get("command") == "stop":
+                self.server.stopping = True
+                self.send(stopped=True)
+                return
+
+            try:
+                self.run_job(request["argv"])
+            except SystemExit:
+                self.send(error="Invalid arguments, see the server's output.")
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            except Exception as e:
+                traceback.print_exc()
+                self.send(error=str(e))
+
+    def run_job(self, argv):
+        args = infer.arg_parse(argv)
+        args.batchsize = self.server.batchsize
+
+        if args.benchmark_index or args.benchmark_batch:
+            raise ValueError("Benchmarks can't run on the server, run them without it.")
+
+        if args.sweep:
+            audios = list(infer.find_inputs(args))
+            infer.write_sweep_index(args, audios)
+            func, tasks = run_sweep, audios
+        else:
+            audios = infer.collect_inputs(args)
+            if args.infer_batch > 1:
+                func, tasks = run_batch, infer.make_batches(args, audios)
+            else:
+                func, tasks = run_file, audios
+
+        tq.tqdm.write(f"Revoicing {len(audios)} files from {args.input_path}")
+        self.send(total=len(audios))
+
+        seconds = 0
+        start = ttime()
+        for count, audio_seconds in self.server.pool.imap_unordered(
+            func, [(args, task) for task in tasks]
+        ):
+            seconds += audio_seconds
+            self.send(done=count)
+
+        elapsed = ttime() - start
+        infer.report_speed(args, seconds, elapsed)
+        self.send(finished=True, seconds=seconds, elapsed=elapsed)
+
+
+class LocalServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+def is_running(args):
+    """Whether another server already listens at the address."""
+    try:
+        if args.socket and hasattr(socket, "AF_UNIX"):
+            with socket.socket(socket.AF_UNIX) as client:
+                client.connect(args.socket)
+        else:
+            socket.create_connection(("127.0.0.1", args.port)).close()
+    except OSError:
+        return False
+    return True
+
+
+def create_server(args):
+    if args.socket and hasattr(socket, "AF_UNIX"):
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)  # left by a server that crashed
+        os.makedirs(os.path.dirname(args.socket), exist_ok=True)
+        return socketserver.UnixStreamServer(args.socket, JobHandler)
+
+    # Only local connections are accepted
+    return LocalServer(("127.0.0.1", args.port), JobHandler)
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", type=str, help="path of the unix socket")
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=32077,
+        help="localhost port to use where unix sockets aren't supported",
+    )
+    parser.add_argument(
+        "--batchsize", type=int, default=1, help="how many RVC processes to spawn"
+    )
+    parser.add_argument(
+        "--num_threads", type=int, help="torch intra-op threads per process"
+    )
+    parser.add_argument(
+        "--interop_threads", type=int, help="torch inter-op threads per process"
+    )
+    parser.add_argument(
+        "--cpu_profile",
+        type=lambda value: value == "True",
+        default=False,
+        help="pin the processes to their own cores",
+    )
+    parser.add_argument(
+        "--models",
+        type=int,
+        default=2,
+        help="how many voice models each process keeps loaded",
+    )
+
+    args = parser.parse_args()
+    sys.argv = sys.argv[:1]
+
+    return args
+
+
+def main():
+    load_dotenv(".env")
+    args = arg_parse()
+
+    if is_running(args):
+        tq.tqdm.write("RVC server is already running.")
+        sys.exit(1)
+
+    with (
+        create_server(args) as server,
+        Pool(args.batchsize, init_server_worker, (args,)) as pool,
+    ):
+        server.pool = pool
+        server.batchsize = args.batchsize
+        server.stopping = False
+
+        tq.tqdm.write(f"RVC server listening on {server.server_address}")
+        try:
+            while not server.stopping:
+                server.handle_request()
+        except KeyboardInterrupt:
+            pass
+
+    if isinstance(server, socketserver.UnixStreamServer):
+        os.unlink(args.socket)
+    tq.tqdm.write("RVC server stopped.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,22 @@
 import argparse
+import json
 
 import config
 
+
+def _sweep_values(value: str):
+    """Parses `<setting>=<value>,<value>...` of `revoice --sweep`."""
+    key, _, values = value.partition("=")
+    if key not in config.RVC_SWEEP_SETTINGS:
+        raise argparse.ArgumentTypeError(
+            f"'{key}' can't be swept, use one of: {', '.join(config.RVC_SWEEP_SETTINGS)}"
+        )
+    try:
+        return key, [json.loads(v) for v in values.split(",")]
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"invalid values of '{key}': {values}") from e
+
+
 main = argparse.ArgumentParser(
     prog="voiceswap",
     description="Tool for automating the creation of AI voice-over mods for Cyberpunk 2077.",
@@ -153,6 +168,12 @@ extract_files.add_argument(
     default=config.WOLVENKIT_OUTPUT,
     nargs=argparse.OPTIONAL,
 )
+extract_files.add_argument(
+    "--delta",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Only extract files that changed since the last extraction and mark them dirty (no by default).",
+)
 
 # export_wem
 export_wem = subcommands.add_parser(
@@ -172,6 +193,18 @@ export_wem.add_argument(
     default=config.WW2OGG_OUTPUT,
     nargs=argparse.OPTIONAL,
 )
+export_wem.add_argument(
+    "--uvr_format",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Output the files in the format isolate_vocals needs, so it doesn't have to convert them (no by default).",
+)
+export_wem.add_argument(
+    "--dirty",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Only process lines changed by the last `extract --delta` (no by default).",
+)
 
 # Isolate vocals
 isolate_vocals = subcommands.add_parser(
@@ -200,8 +233,145 @@ isolate_vocals.add_argument(
 isolate_vocals.add_argument(
     "--batchsize",
     type=int,
+    help="How many files to process at once, found by `autotune uvr` or 1 by default",
+)
+isolate_vocals.add_argument(
+    "--dirty",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Only process lines changed by the last `extract --delta` (no by default).",
+)
+isolate_vocals.add_argument(
+    "--in_memory",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Pass split vocals to dereverb without saving them to disk, every worker loads both models (no by default).",
+)
+isolate_vocals.add_argument(
+    "--clip_batch",
+    type=int,
     default=1,
-    help="How many files to process at once",
+    help="How many short files to separate together in one model call",
+)
+isolate_vocals.add_argument(
+    "--quantize",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Run the models' linear and LSTM layers in int8 on CPU, faster but less accurate, see `compare_quantized` (no by default).",
+)
+
+# benchmark_uvr
+benchmark_uvr = subcommands.add_parser(
+    "benchmark_uvr",
+    help="Measures UVR throughput of short files on CPU for different --clip_batch sizes.",
+)
+benchmark_uvr.add_argument(
+    "input",
+    type=str,
+    help="Path to folder of converted wav files.",
+    default=config.CACHE_PATH + "/" + config.UVR_FORMAT_CACHE,
+    nargs=argparse.OPTIONAL,
+)
+benchmark_uvr.add_argument(
+    "--sizes",
+    type=int,
+    nargs="+",
+    default=[1, 2, 4, 8, 16],
+    help="Batch sizes to measure",
+)
+benchmark_uvr.add_argument(
+    "--count",
+    type=int,
+    default=32,
+    help="How many files to separate for each batch size",
+)
+benchmark_uvr.add_argument(
+    "--model",
+    type=str,
+    default=config.UVR_FIRST_MODEL,
+    help="The model to benchmark",
+)
+
+# compare_quantized
+compare_quantized = subcommands.add_parser(
+    "compare_quantized",
+    help="Compares speed and quality of isolate_vocals --quantize with the full models on CPU.",
+)
+compare_quantized.add_argument(
+    "input",
+    type=str,
+    help="Path to folder of converted wav files.",
+    default=config.CACHE_PATH + "/" + config.UVR_FORMAT_CACHE,
+    nargs=argparse.OPTIONAL,
+)
+compare_quantized.add_argument(
+    "--count",
+    type=int,
+    default=16,
+    help="How many files to compare",
+)
+
+# autotune
+autotune = subcommands.add_parser(
+    "autotune",
+    help="Finds the fastest number of workers and threads for isolate_vocals or revoice on this machine.",
+)
+autotune.add_argument(
+    "target",
+    type=str,
+    choices=["uvr", "rvc"],
+    help="Which phase to tune.",
+)
+autotune.add_argument(
+    "--input",
+    type=str,
+    help="Folder of files to sample, the input of the phase by default.",
+)
+autotune.add_argument(
+    "--sample",
+    type=int,
+    default=16,
+    help="How many files to process for each combination, for uvr it must be more than the largest worker count",
+)
+autotune.add_argument(
+    "--workers",
+    type=int,
+    nargs="+",
+    help="Worker counts to try, powers of two up to the number of cores by default",
+)
+autotune.add_argument(
+    "--threads",
+    type=int,
+    nargs="+",
+    help="Thread counts per worker to try, cores divided by workers by default",
+)
+autotune.add_argument(
+    "--interop_threads",
+    type=int,
+    nargs="+",
+    default=[1, 2],
+    help="Inter-op thread counts per worker to try",
+)
+autotune.add_argument(
+    "--model_name",
+    type=str,
+    help="RVC model's filename in assets/weights folder, required for rvc",
+)
+autotune.add_argument(
+    "--index_path",
+    type=str,
+    help="RVC index path, relative to RVC",
+)
+autotune.add_argument(
+    "--f0method",
+    type=str,
+    default="rmvpe",
+    help="harvest or pm or rmvpe or others",
+)
+autotune.add_argument(
+    "--device",
+    type=str,
+    help="gpu id or 'cpu'",
 )
 
 # map_subtitles
@@ -329,8 +499,7 @@ revoice.add_argument(
 revoice.add_argument(
     "--batchsize",
     type=int,
-    default=1,
-    help="how many RVC processes to spawn",
+    help="how many RVC processes to spawn, found by `autotune rvc` or 1 by default",
 )
 revoice.add_argument(
     "--f0method",
@@ -400,6 +569,111 @@ revoice.add_argument(
     default=".wav" + config.UVR_SECOND_SUFFIX,
     help="What suffix must the file have to be processed",
 )
+revoice.add_argument(
+    "--infer_batch",
+    type=int,
+    help="How many short files each RVC process converts together, 1 by default",
+)
+revoice.add_argument(
+    "--benchmark_batch",
+    type=int,
+    help="Instead of revoicing, convert this many files one by one and in batches of --infer_batch and compare the speed.",
+)
+revoice.add_argument(
+    "--follow",
+    action=argparse.BooleanOptionalAction,
+    help="Revoice files as soon as a running `isolate_vocals` writes them, and finish when it does. Always starts RVC, even with --server (no by default).",
+)
+revoice.add_argument(
+    "--server",
+    action=argparse.BooleanOptionalAction,
+    help="Run on the RVC server started by `rvc_server`, without loading the models again. Falls back to starting RVC when the server isn't running (no by default).",
+)
+revoice.add_argument(
+    "--cpu_profile",
+    action=argparse.BooleanOptionalAction,
+    help="Run on CPU with int8 quantized models, in inference mode and with each process pinned to its own cores (no by default).",
+)
+revoice.add_argument(
+    "--sweep",
+    type=_sweep_values,
+    nargs="+",
+    metavar="SETTING=VALUES",
+    help="Instead of revoicing, revoice a sample of files with every combination of given values, e.g. `--sweep f0up_key=2,4 index_rate=0.5,0.9`.",
+)
+revoice.add_argument(
+    "--sweep_sample",
+    type=int,
+    help=f"How many files to sweep, {config.RVC_SWEEP_SAMPLE} by default",
+)
+revoice.add_argument(
+    "--sweep_path",
+    type=str,
+    help=f"Where to put the sweep's results, {config.RVC_SWEEP_OUTPUT} by default",
+)
+revoice.add_argument(
+    "--feature_cache",
+    action=argparse.BooleanOptionalAction,
+    help="Cache HuBERT features of the input audio, so re-runs with other models or settings are faster. Takes a few GB for the whole game (no by default).",
+)
+revoice.add_argument(
+    "--f0_cache",
+    action=argparse.BooleanOptionalAction,
+    help="Cache raw pitch curves of the input audio, so re-runs with other f0up_key, f0_contrast or filter_radius skip pitch detection (no by default).",
+)
+revoice.add_argument(
+    "--index_mmap",
+    action=argparse.BooleanOptionalAction,
+    help="Memory-map the index and its vectors instead of reading them whole into every process, the vectors are saved next to the index for that (no by default).",
+)
+revoice.add_argument(
+    "--benchmark_index",
+    type=int,
+    help="Instead of revoicing, measure loading the index this many times with and without caching.",
+)
+revoice.add_argument(
+    "--dirty",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Only process lines changed by the last `extract --delta` (no by default).",
+)
+
+# RVC server
+rvc_server = subcommands.add_parser(
+    "rvc_server",
+    help="Runs RVC processes that keep the models loaded, used by `revoice --server`.",
+)
+rvc_server.add_argument(
+    "--batchsize",
+    type=int,
+    help="how many RVC processes to spawn, found by `autotune rvc` or 1 by default",
+)
+rvc_server.add_argument(
+    "--num_threads",
+    type=int,
+    help="torch intra-op threads per process",
+)
+rvc_server.add_argument(
+    "--interop_threads",
+    type=int,
+    help="torch inter-op threads per process",
+)
+rvc_server.add_argument(
+    "--models",
+    type=int,
+    help=f"How many voice models each process keeps loaded, {config.RVC_SERVER_MODELS} by default",
+    default=config.RVC_SERVER_MODELS,
+)
+rvc_server.add_argument(
+    "--cpu_profile",
+    action=argparse.BooleanOptionalAction,
+    help="Pin each process to its own cores, use with `revoice --cpu_profile` (no by default).",
+)
+rvc_server.add_argument(
+    "--stop",
+    action="store_true",
+    help="Stop the running server after its current job.",
+)
 
 # Revoice SFX
 revoice_sfx = subcommands.add_parser(
@@ -456,6 +730,44 @@ revoice_silent.add_argument(
     nargs=argparse.OPTIONAL,
 )
 
+# Preview
+preview = subcommands.add_parser(
+    "preview",
+    help="Runs a small representative sample of lines through isolate_vocals, revoice and merge_vocals.",
+    parents=[revoice],
+    conflict_handler="resolve",
+)
+preview.add_argument(
+    "--input",
+    type=str,
+    help="Folder with the exported files, relative to VoiceSwap",
+    default=config.WW2OGG_OUTPUT,
+)
+preview.add_argument(
+    "--output",
+    type=str,
+    help="Where to put the results and the playlist, relative to VoiceSwap. Its previous content is removed.",
+    default=config.PREVIEW_OUTPUT,
+)
+preview.add_argument(
+    "--count",
+    type=int,
+    help="How many lines to preview, picked by their folder, duration and loudness.",
+    default=config.PREVIEW_COUNT,
+)
+preview.add_argument(
+    "--voice-vol",
+    type=float,
+    help="Adjust the volume of the voice. 1 is original volume.",
+    default=1.5,
+)
+preview.add_argument(
+    "--effect-vol",
+    type=float,
+    help="Adjust the volume of the effects. 1 is original volume.",
+    default=1,
+)
+
 # Merge vocals
 merge_vocals = subcommands.add_parser("merge_vocals", help="Merge vocals with effects.")
 merge_vocals.add_argument(
@@ -512,6 +824,12 @@ merge_vocals.add_argument(
     action=argparse.BooleanOptionalAction,
     help="Whether to overwrite old files",
 )
+merge_vocals.add_argument(
+    "--dirty",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Only process lines changed by the last `extract --delta` (no by default).",
+)
 
 # wwise convert
 wwise_import = subcommands.add_parser(
@@ -544,6 +862,12 @@ wwise_import.add_argument(
     action=argparse.BooleanOptionalAction,
     help="Whether to overwrite files in ouzput dir",
 )
+wwise_import.add_argument(
+    "--dirty",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Only process lines changed by the last `extract --delta` (no by default).",
+)
 
 # Move Wwise files
 move_wwise_files = subcommands.add_parser(
@@ -615,6 +939,30 @@ pack_files.add_argument(
     default=config.PACKED_OUTPUT,
     nargs=argparse.OPTIONAL,
 )
+pack_files.add_argument(
+    "--incremental",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Only pack files changed since the last full pack into a delta archive (no by default).",
+)
+pack_files.add_argument(
+    "--native",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Pack without WolvenKit; with --incremental unchanged files are reused from the last archive (no by default).",
+)
+
+# Verify native packing
+verify_pack = subcommands.add_parser(
+    "verify_pack",
+    help="Packs a folder with both WolvenKit and the native writer and compares the archives.",
+)
+verify_pack.add_argument(
+    "folder",
+    type=str,
+    help="The folder to pack, synthetic test files are generated by default.",
+    nargs=argparse.OPTIONAL,
+)
 
 # Zip folder
 zip_files = subcommands.add_parser("zip", help="Zips a folder for distribution.")
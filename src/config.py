@@ -9,7 +9,15 @@ METADATA_EXTRACT_PATH = METADATA_PATH + "/raw"
 SFX_EXPORT_PATH = SFX_CACHE_PATH + "/exported"
 SFX_MAP_PATH = METADATA_PATH + "/sfx_map.json"
 
+ARCHIVE_INDEX_PATH = METADATA_PATH + "/archive_index.json"
+AUTOTUNE_PATH = METADATA_PATH + "/autotune.json"
+ARCHIVE_HASHES = "./libs/WolvenKit/Resources/archivehashes.zip"
+
 WOLVENKIT_OUTPUT = CACHE_PATH + "/archive"
+WOLVENKIT_JOBS = 2  # per drive
+EXTRACT_MANIFEST = "_extract_manifest.json"
+
+DIRTY_PATH = CACHE_PATH + "/dirty.json"
 
 WW2OGG_OUTPUT = CACHE_PATH + "/raw"
 
@@ -23,13 +31,60 @@ UVR_SECOND_MODEL = "Reverb_HQ_By_FoxJoy.onnx"
 UVR_SECOND_SUFFIX = UVR_FIRST_SUFFIX + "_instrumental.wav"
 UVR_SECOND_SUFFIX_O = UVR_FIRST_SUFFIX + "_reverb.wav"
 UVR_SECOND_CACHE = "isolated"
+# How often can UVR workers be moved between models, in seconds
+UVR_REBALANCE_INTERVAL = 30
+# Max length of short files separated together in one call, in seconds
+UVR_BATCH_SECONDS = 60
+# Silence between files separated together, in seconds
+UVR_BATCH_GAP = 0.5
+# Files longer than this are separated in windows of this length, in seconds
+UVR_CHUNK_SECONDS = 120
+# Overlap of the windows that is crossfaded, in seconds
+UVR_CHUNK_OVERLAP = 2
+# How many times to retry files that failed on lack of memory, or for other reasons
+UVR_RETRIES = 3
+UVR_INPUT_RETRIES = 1
+# Seconds to wait before the first retry, doubled on each next one
+UVR_RETRY_DELAY = 5
+# Files are written with this prefix first and renamed once complete
+UVR_PARTIAL_PREFIX = ".partial_"
+# Written into the output folder when isolate_vocals ends, `revoice --follow` stops then
+UVR_DONE_MARKER = "_uvr_done"
+# Files that failed too many times
+UVR_QUARANTINE_PATH = CACHE_PATH + "/uvr_quarantine.json"
 
 TTS_OUTPUT = CACHE_PATH + "/tts"
 
 RVC_OUTPUT = CACHE_PATH + "/voiced"
+# HuBERT features of the input audio, shared by all voice models
+RVC_FEATURE_CACHE = CACHE_PATH + "/rvc_features"
+# Raw pitch curves of the input audio, before shifting and other changes
+RVC_F0_CACHE = CACHE_PATH + "/rvc_f0"
+# Settings of `revoice` that can be swept
+RVC_SWEEP_SETTINGS = (
+    "f0up_key",
+    "f0_contrast",
+    "index_rate",
+    "filter_radius",
+    "rms_mix_rate",
+    "protect",
+)
+RVC_SWEEP_OUTPUT = CACHE_PATH + "/sweep"
+# Where `rvc_server` listens, the port is used where unix sockets aren't supported
+RVC_SERVER_SOCKET = TMP_PATH + "/rvc_server.sock"
+RVC_SERVER_PORT = 32077
+RVC_SERVER_MODELS = 2
+RVC_SWEEP_SAMPLE = 20
 SFX_RVC_OUTPUT = CACHE_PATH + "/voiced_sfx"
 
 MERGED_OUTPUT = CACHE_PATH + "/merged"
+
+PREVIEW_OUTPUT = CACHE_PATH + "/preview"
+PREVIEW_COUNT = 24
+# How many candidates per previewed line are probed for duration and loudness
+PREVIEW_CANDIDATES = 4
+# Into how many groups are duration and loudness divided
+PREVIEW_BINS = 3
 MERGED_SILENT_FILENAME = "_silent_files.json"
 
 WWISE_PROJECT = CACHE_PATH + "/wwise_project"
@@ -39,3 +94,10 @@ SFX_PAKS_OUTPUT = CACHE_PATH + "/complete_sfx"
 ARCHIVE_NAME = "voiceswap"
 
 PACKED_OUTPUT = CACHE_PATH + "/packed"
+PACK_MANIFEST = CACHE_PATH + "/pack_manifest.json"
+PACK_STAGING = CACHE_PATH + "/pack_staging"
+# Mod archives load alphabetically and the first one wins, so the delta goes first
+PACK_DELTA_PREFIX = "#"
+PACK_DELTA_SUFFIX = "_delta"
+# Fraction of changed files above which a full pack is done instead
+PACK_DELTA_MAX = 0.25
@@ -0,0 +1,633 @@
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import zipfile
+from dataclasses import dataclass
+
+from tqdm import tqdm
+
+import config
+
+# RDAR header: magic, version, index position, index size, debug position,
+# debug size, file size
+_HEADER = struct.Struct("<4sIQIQIQ")
+# Index header: table offset, table size, crc, file count, segment count,
+# dependency count
+_INDEX = struct.Struct("<IIQIII")
+# File entry: name hash, timestamp, inline buffer count, segments start,
+# segments end, dependencies start, dependencies end, sha1
+_FILE_ENTRY = struct.Struct("<QqIIIII20s")
+# Segment: offset, size on disk, size
+_SEGMENT = struct.Struct("<QII")
+
+_MAGIC = b"RDAR"
+_VERSION = 12
+_KARK = b"KARK"
+# Header is followed by space reserved for custom data
+_DATA_START = 0xAC
+# FILETIME of the unix epoch
+_FILETIME_EPOCH = 116444736000000000
+
+_CRC64_POLY = 0x42F0E1EBA9EA3693
+
+_FNV_OFFSET = 0xCBF29CE484222325
+_FNV_PRIME = 0x100000001B3
+_MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+
+def fnv1a64(path: str):
+    """Hashes a depot path the same way the game does."""
+    result = _FNV_OFFSET
+    for byte in normalize_path(path).encode():
+        result = ((result ^ byte) * _FNV_PRIME) & _MASK_64
+    return result
+
+
+def normalize_path(path: str):
+    """Converts a path to the game's depot path format."""
+    return path.replace("/", "\\").lower()
+
+
+@dataclass
+class Changes:
+    """Paths of files that changed between two extractions."""
+
+    added: list[str]
+    changed: list[str]
+    removed: list[str]
+
+
+@dataclass
+class ArchiveEntry:
+    """A file stored in one of the game's archives."""
+
+    hash: int
+    archive: str
+    offset: int
+    zsize: int
+    size: int
+    segments: int
+    sha1: str
+    path: str = None
+
+    @property
+    def is_raw(self):
+        """Whether the file can be copied out of the archive without decompression."""
+        return self.segments == 1 and self.zsize == self.size
+
+    def as_list(self):
+        return [
+            self.hash,
+            self.offset,
+            self.zsize,
+            self.size,
+            self.segments,
+            self.sha1,
+            self.path,
+        ]
+
+
+def read_archive(archive_path: str):
+    """Reads the file table of given .archive file."""
+    with (
+        open(archive_path, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+    ):
+        magic, _version, index_pos, _index_size, *_rest = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError(f"{archive_path} is not a valid archive")
+
+        _offset, _size, _crc, file_count, segment_count, _deps = _INDEX.unpack_from(
+            data, index_pos
+        )
+
+        files_pos = index_pos + _INDEX.size
+        segments_pos = files_pos + file_count * _FILE_ENTRY.size
+
+        segments = list(
+            _SEGMENT.iter_unpack(
+                data[segments_pos : segments_pos + segment_count * _SEGMENT.size]
+            )
+        )
+
+        for (
+            name_hash,
+            _timestamp,
+            _buffers,
+            segments_start,
+            segments_end,
+            _deps_start,
+            _deps_end,
+            sha1,
+        ) in _FILE_ENTRY.iter_unpack(
+            data[files_pos : files_pos + file_count * _FILE_ENTRY.size]
+        ):
+            offset, zsize, size = segments[segments_start]
+            yield ArchiveEntry(
+                name_hash,
+                archive_path,
+                offset,
+                zsize,
+                size,
+                segments_end - segments_start,
+                sha1.hex(),
+            )
+
+
+@dataclass
+class ArchiveLayout:
+    """Header and index fields of an archive, for comparing it with another writer."""
+
+    version: int
+    index_size: int
+    debug_size: int
+    # File size stored in the header, and the actual one
+    file_size: int
+    disk_size: int
+    table_offset: int
+    table_size: int
+    # CRC stored in the index, and the one computed over its tables
+    crc: int
+    tables_crc: int
+    file_count: int
+    segment_count: int
+    dependency_count: int
+    # Offset of the first file's data
+    data_start: int
+    # Largest power of two up to 4 KiB that all data offsets are aligned to
+    alignment: int
+    # Name hash to (timestamp, inline buffer count, segment count, dependency count)
+    files: dict[int, tuple]
+
+
+def read_layout(archive_path: str):
+    """Reads header and index fields of given .archive file."""
+    with (
+        open(archive_path, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+    ):
+        (
+            magic,
+            version,
+            index_pos,
+            index_size,
+            _debug_pos,
+            debug_size,
+            file_size,
+        ) = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError(f"{archive_path} is not a valid archive")
+
+        (
+            table_offset,
+            table_size,
+            crc,
+            file_count,
+            segment_count,
+            dependency_count,
+        ) = _INDEX.unpack_from(data, index_pos)
+
+        files_pos = index_pos + _INDEX.size
+        segments_pos = files_pos + file_count * _FILE_ENTRY.size
+        tables_end = segments_pos + segment_count * _SEGMENT.size + dependency_count * 8
+
+        files = {}
+        for (
+            name_hash,
+            timestamp,
+            buffers,
+            segments_start,
+            segments_end,
+            deps_start,
+            deps_end,
+            _sha1,
+        ) in _FILE_ENTRY.iter_unpack(data[files_pos:segments_pos]):
+            files[name_hash] = (
+                timestamp,
+                buffers,
+                segments_end - segments_start,
+                deps_end - deps_start,
+            )
+
+        offsets = [
+            offset
+            for offset, _zsize, _size in _SEGMENT.iter_unpack(
+                data[segments_pos : segments_pos + segment_count * _SEGMENT.size]
+            )
+        ]
+
+        alignment = 4096
+        while alignment > 1 and any(offset % alignment for offset in offsets):
+            alignment //= 2
+
+        return ArchiveLayout(
+            version,
+            index_size,
+            debug_size,
+            file_size,
+            len(data),
+            table_offset,
+            table_size,
+            crc,
+            crc64(data[files_pos:tables_end]),
+            file_count,
+            segment_count,
+            dependency_count,
+            min(offsets, default=index_pos),
+            alignment,
+            files,
+        )
+
+
+def get_archives(game_path: str):
+    """Returns all non-mod .archive files of the game."""
+    archives = []
+    archive_root = os.path.join(game_path, "archive/pc")
+    for folder in sorted(os.listdir(archive_root)):
+        if folder == "mod":
+            continue
+
+        folder_path = os.path.join(archive_root, folder)
+        if not os.path.isdir(folder_path):
+            continue
+
+        for file in sorted(os.listdir(folder_path)):
+            if file.endswith(".archive"):
+                archives.append(os.path.join(folder_path, file))
+
+    return archives
+
+
+def _get_hashes_path():
+    return os.getenv("ARCHIVE_HASHES_PATH") or config.ARCHIVE_HASHES
+
+
+def _read_path_list(path: str):
+    """Reads the list of known depot paths (one per line, optionally as CSV)."""
+
+    def parse(lines):
+        for line in lines:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            yield line.split(",", 1)[0]
+
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                with archive.open(name) as f:
+                    yield from parse(line.decode() for line in f)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            yield from parse(f)
+
+
+def _fingerprint(archives: list[str]):
+    """Identifies the game build by its archives."""
+    prints = []
+    for archive in archives:
+        stat = os.stat(archive)
+        prints.append([os.path.basename(archive), stat.st_size, stat.st_mtime_ns])
+
+    hashes_path = _get_hashes_path()
+    if os.path.exists(hashes_path):
+        prints.append([hashes_path, os.stat(hashes_path).st_mtime_ns])
+
+    return prints
+
+
+class ArchiveIndex:
+    """Index of all files in the game's archives."""
+
+    entries: dict[int, ArchiveEntry]
+
+    def __init__(self, entries: dict[int, ArchiveEntry]):
+        self.entries = entries
+
+    @classmethod
+    def build(cls, archives: list[str], hashes_path: str):
+        """Reads all given archives and resolves their file names."""
+        entries = {}
+        for archive in tqdm(archives, desc="Indexing archives", unit="archive"):
+            for entry in read_archive(archive):
+                # Later archives override earlier ones, same as in the game
+                entries[entry.hash] = entry
+
+        for path in tqdm(
+            _read_path_list(hashes_path), desc="Resolving file names", unit="path"
+        ):
+            entry = entries.get(fnv1a64(path))
+            if entry is not None:
+                entry.path = normalize_path(path)
+
+        return cls(entries)
+
+    @classmethod
+    def load(cls, game_path: str, cache_path=config.ARCHIVE_INDEX_PATH):
+        """Loads the index from cache or builds it if the game was updated."""
+        archives = get_archives(game_path)
+        fingerprint = _fingerprint(archives)
+
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+
+            if cache["fingerprint"] == fingerprint:
+                return cls.from_dict(cache)
+        except (IOError, ValueError, KeyError):
+            pass
+
+        hashes_path = _get_hashes_path()
+        if not os.path.exists(hashes_path):
+            raise FileNotFoundError(f"Could not find archive hashes at {hashes_path}")
+
+        index = cls.build(archives, hashes_path)
+
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump(index.as_dict(fingerprint), f, separators=(",", ":"))
+
+        return index
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """Creates index from its cached form."""
+        entries = {}
+        for archive, items in data["archives"].items():
+            for item in items:
+                entry = ArchiveEntry(item[0], archive, *item[1:])
+                entries[entry.hash] = entry
+
+        return cls(entries)
+
+    def as_dict(self, fingerprint: list):
+        """Returns the index in a form that can be cached."""
+        archives = {}
+        for entry in self.entries.values():
+            archives.setdefault(entry.archive, []).append(entry.as_list())
+
+        return {"fingerprint": fingerprint, "archives": archives}
+
+    def select(self, pattern: str):
+        """Returns entries whose path matches given regex pattern."""
+        regex = re.compile(pattern)
+        return [
+            entry
+            for entry in self.entries.values()
+            if entry.path is not None and regex.search(entry.path)
+        ]
+
+
+_g_index = None
+
+
+def get_index():
+    """Returns the index of the game's archives or None if it's not available."""
+    global _g_index
+
+    if _g_index is None:
+        game_path = os.getenv("CYBERPUNK_PATH")
+        if not game_path:
+            tqdm.write("Archive index not available (CYBERPUNK_PATH is not set).")
+            return None
+
+        try:
+            _g_index = ArchiveIndex.load(game_path)
+        # Truncated or damaged archives fail while unpacking their tables
+        except (OSError, ValueError, IndexError, struct.error) as e:
+            tqdm.write(f"Archive index not available ({e}), using WolvenKit only.")
+            return None
+
+    return _g_index
+
+
+def extract_entries(entries: list[ArchiveEntry], output_path: str):
+    """
+    Copies uncompressed entries out of their archives.
+    Returns entries that have to be extracted by WolvenKit.
+    """
+    rest = []
+    by_archive = {}
+    for entry in entries:
+        if entry.is_raw:
+            by_archive.setdefault(entry.archive, []).append(entry)
+        else:
+            rest.append(entry)
+
+    for archive, archive_entries in by_archive.items():
+        with (
+            open(archive, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+        ):
+            for entry in archive_entries:
+                if data[entry.offset : entry.offset + 4] == _KARK:
+                    rest.append(entry)
+                    continue
+
+                path = os.path.join(output_path, *entry.path.split("\\"))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as out:
+                    out.write(data[entry.offset : entry.offset + entry.size])
+
+    return rest
+
+
+def read_manifest(path: str):
+    """Reads paths and content hashes of previously extracted files."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_manifest(path: str, entries: list[ArchiveEntry]):
+    """Writes paths and content hashes of extracted files."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({entry.path: entry.sha1 for entry in entries}, f, indent=4)
+
+
+def diff_manifest(manifest: dict[str, str], entries: list[ArchiveEntry]):
+    """Compares previously extracted files with given entries."""
+    added = []
+    changed = []
+    for entry in entries:
+        old_hash = manifest.get(entry.path)
+        if old_hash is None:
+            added.append(entry.path)
+        elif old_hash != entry.sha1:
+            changed.append(entry.path)
+
+    current = set(entry.path for entry in entries)
+    removed = [path for path in manifest if path not in current]
+
+    return Changes(added, changed, removed)
+
+
+def _make_crc64_table():
+    table = []
+    for i in range(256):
+        crc = i << 56
+        for _ in range(8):
+            if crc & (1 << 63):
+                crc = ((crc << 1) ^ _CRC64_POLY) & _MASK_64
+            else:
+                crc = (crc << 1) & _MASK_64
+        table.append(crc)
+    return table
+
+
+_CRC64_TABLE = _make_crc64_table()
+
+
+def crc64(data: bytes):
+    """CRC-64/ECMA-182 of given data."""
+    crc = 0
+    for byte in data:
+        crc = _CRC64_TABLE[((crc >> 56) ^ byte) & 0xFF] ^ ((crc << 8) & _MASK_64)
+    return crc
+
+
+class ArchiveWriter:
+    """Writes an .archive in one sequential pass, computing hashes on the way."""
+
+    __file = None
+    __entries: list
+    __position: int
+
+    def __init__(self, path: str):
+        self.__file = open(path, "wb", buffering=1024 * 1024)
+        self.__file.write(b"\0" * _DATA_START)
+        self.__entries = []
+        self.__position = _DATA_START
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, _exc, _traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.__file.close()
+
+    def add_file(self, depot_path: str, source: str):
+        """Streams given file into the archive."""
+        sha1 = hashlib.sha1()
+        size = 0
+        with open(source, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                sha1.update(chunk)
+                self.__file.write(chunk)
+                size += len(chunk)
+
+        self.__entries.append(
+            (
+                fnv1a64(depot_path),
+                self.__position,
+                size,
+                size,
+                sha1.digest(),
+                os.stat(source).st_mtime_ns,
+            )
+        )
+        self.__position += size
+
+    def add_entry(self, entry: ArchiveEntry, data: bytes):
+        """Writes already packed data of an entry from another archive."""
+        self.__file.write(data)
+        self.__entries.append(
+            (
+                entry.hash,
+                self.__position,
+                entry.zsize,
+                entry.size,
+                bytes.fromhex(entry.sha1),
+                0,
+            )
+        )
+        self.__position += entry.zsize
+
+    def close(self):
+        """Writes the index and the header."""
+        # The game looks files up by hash, keep the table sorted
+        self.__entries.sort(key=lambda entry: entry[0])
+
+        files = bytearray()
+        segments = bytearray()
+        for i, (name_hash, offset, zsize, size, sha1, mtime_ns) in enumerate(
+            self.__entries
+        ):
+            timestamp = mtime_ns // 100 + _FILETIME_EPOCH if mtime_ns else 0
+            files += _FILE_ENTRY.pack(name_hash, timestamp, 0, i, i + 1, 0, 0, sha1)
+            segments += _SEGMENT.pack(offset, zsize, size)
+
+        tables = bytes(files + segments)
+        count = len(self.__entries)
+        index = (
+            _INDEX.pack(
+                8, _INDEX.size - 8 + len(tables), crc64(tables), count, count, 0
+            )
+            + tables
+        )
+
+        index_position = self.__position
+        self.__file.write(index)
+        file_size = index_position + len(index)
+
+        self.__file.seek(0)
+        self.__file.write(
+            _HEADER.pack(_MAGIC, _VERSION, index_position, len(index), 0, 0, file_size)
+        )
+        self.__file.close()
+
+
+def write_archive(
+    input_path: str, output_file: str, changed: set[str] = None, base: str = None
+):
+    """
+    Packs all files in given folder into an archive.
+    If a `base` archive is given, files that are in it and not in `changed`
+    are copied from it instead of the folder.
+    Returns number of files read from the folder.
+    """
+    input_path = input_path.rstrip("\\/")
+    files = []
+    for root, _dirs, names in os.walk(input_path):
+        relative_root = root[len(input_path) + 1 :]
+        files.extend(os.path.join(relative_root, name) for name in names)
+
+    reusable = {}
+    if base is not None:
+        reusable = {entry.hash: entry for entry in read_archive(base)}
+
+    to_write = []
+    to_reuse = []
+    for file in files:
+        entry = reusable.get(fnv1a64(file))
+        if entry is None or entry.segments != 1 or (changed and file in changed):
+            to_write.append(file)
+        else:
+            to_reuse.append(entry)
+
+    tmp_file = output_file + ".tmp"
+    with ArchiveWriter(tmp_file) as writer:
+        for file in tqdm(to_write, desc="Packing files", unit="file"):
+            writer.add_file(file, os.path.join(input_path, file))
+
+        if len(to_reuse) > 0:
+            to_reuse.sort(key=lambda entry: entry.offset)
+            with (
+                open(base, "rb") as f,
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+            ):
+                for entry in tqdm(to_reuse, desc="Reusing packed files", unit="file"):
+                    writer.add_entry(
+                        entry, data[entry.offset : entry.offset + entry.zsize]
+                    )
+
+    os.replace(tmp_file, output_file)
+    return len(to_write)
@@ -0,0 +1,135 @@
+import os
+import random
+import shutil
+import time
+
+from tqdm import tqdm
+
+import config
+from lib import rvc, uvr
+from util import find_files
+from util.tuning import save_tuning
+
+
+def get_candidates(
+    workers: list[int] = None,
+    threads: list[int] = None,
+    interop_threads: list[int] = None,
+):
+    """Returns combinations of workers and threads that don't oversubscribe the CPU."""
+    cores = os.cpu_count()
+
+    if workers is None:
+        workers = [1]
+        while workers[-1] * 2 <= cores:
+            workers.append(workers[-1] * 2)
+
+    candidates = []
+    for n_workers in workers:
+        for n_threads in threads or [max(1, cores // n_workers)]:
+            if n_workers * n_threads > cores:
+                continue
+
+            for n_interop in interop_threads or [1, 2]:
+                candidates.append(
+                    {
+                        "workers": n_workers,
+                        "threads": n_threads,
+                        "interop_threads": n_interop,
+                    }
+                )
+
+    return candidates
+
+
+def _get_sample(input_path: str, size: int, suffix: str = None):
+    files = sorted(find_files(input_path, suffix))
+    return random.Random(2077).sample(files, min(size, len(files)))
+
+
+async def _tune(kind: str, candidates: list[dict], measure):
+    """Measures all candidates, saves and returns the fastest one."""
+    best = None
+    best_speed = 0
+
+    for candidate in candidates:
+        speed = await measure(candidate)
+        tqdm.write(
+            f"{candidate['workers']} workers x {candidate['threads']} threads"
+            + f" ({candidate['interop_threads']} inter-op): {speed:.2f} files/s"
+        )
+
+        if speed > best_speed:
+            best = candidate
+            best_speed = speed
+
+    tqdm.write(f"Best {kind} settings: {best}")
+    save_tuning(kind, {**best, "files_per_second": best_speed})
+    return best
+
+
+async def tune_uvr(input_path: str, sample_size: int, candidates: list[dict]):
+    """Finds the fastest settings for `isolate_vocals` on converted files."""
+    files = _get_sample(input_path, sample_size, ".wav")
+    if len(files) == 0:
+        tqdm.write("No files to tune on, run isolate_vocals first.")
+        return None
+
+    # Each worker gets a file to warm up on and at least one more is timed
+    measurable = [c for c in candidates if c["workers"] < len(files)]
+    if len(measurable) < len(candidates):
+        tqdm.write(
+            f"Skipping candidates with {len(files)} workers or more,"
+            + f" use --sample above {max(c['workers'] for c in candidates)} to measure them."
+        )
+    if len(measurable) == 0:
+        tqdm.write("No candidates to measure on this sample.")
+        return None
+
+    async def measure(candidate: dict):
+        return await uvr.measure_throughput(
+            input_path,
+            files,
+            candidate["workers"],
+            candidate["threads"],
+            candidate["interop_threads"],
+        )
+
+    return await _tune("uvr", measurable, measure)
+
+
+async def tune_rvc(
+    input_path: str,
+    sample_size: int,
+    candidates: list[dict],
+    suffix: str,
+    **kwargs,
+):
+    """
+    Finds the fastest settings for `revoice` with given RVC arguments.
+    The time includes loading of the models.
+    """
+    files = _get_sample(input_path, sample_size, suffix)
+    if len(files) == 0:
+        tqdm.write("No files to tune on, run isolate_vocals first.")
+        return None
+
+    output_path = os.path.join(config.TMP_PATH, "autotune_rvc")
+
+    async def measure(candidate: dict):
+        shutil.rmtree(output_path, ignore_errors=True)
+
+        start = time.monotonic()
+        await rvc.batch_rvc(
+            input_path,
+            output_path,
+            True,
+            files,
+            batchsize=candidate["workers"],
+            num_threads=candidate["threads"],
+            interop_threads=candidate["interop_threads"],
+            **kwargs,
+        )
+        return len(files) / (time.monotonic() - start)
+
+    return await _tune("rvc", candidates, measure)
@@ -3,9 +3,11 @@ import re
 import json
 import asyncio
 import string
+import wave
 from dataclasses import dataclass
 from tqdm import tqdm
 from util import Parallel, SubprocessException, spawn
+from util.dirty import line_key
 import config
 
 FFMPEG_ARGS = (
@@ -65,17 +67,24 @@ async def probe_volume(path: str):
             err.decode(),
         )[0].strip()
     )
-    return {"mean": mean_volume, "max": max_volume}
+    duration = re.findall(r"Duration: (\d+):(\d+):(\d+\.\d+)", err.decode())
+    duration = (
+        sum(float(x) * 60**i for i, x in enumerate(reversed(duration[0])))
+        if len(duration) > 0
+        else 0
+    )
+    return {"mean": mean_volume, "max": max_volume, "duration": duration}
 
 
-async def convert(source: str, output: str, *args):
-    """Converts a file to a file"""
+async def convert(source: str, output: str, *args, **kwargs):
+    """Converts a file to a file, `-` as source reads from given stdin"""
 
     process = await _spawn_ffmpeg(
         *("-i", source),
         *args,
         output,
         "-y",
+        **kwargs,
     )
     result = await process.wait()
 
@@ -85,16 +94,53 @@ async def convert(source: str, output: str, *args):
         )
 
 
-async def to_wav(source: str, output: str, *args):
+async def to_wav(source: str, output: str, *args, **kwargs):
     """Converts source to WAV format for RVC/game."""
     return await convert(
         source,
         *WAV_ARGS,
         output,
         *args,
+        **kwargs,
     )
 
 
+def is_wav_format(path: str):
+    """Checks whether the file already is in the format `to_wav` outputs."""
+    try:
+        with wave.open(path, "rb") as f:
+            return (
+                f.getcomptype() == "NONE"
+                and f.getsampwidth() == 2
+                and f.getnchannels() == 2
+                and f.getframerate() == 44100
+            )
+    except (wave.Error, EOFError, OSError):
+        return False
+
+
+async def to_wav_if_needed(source: str, output: str):
+    """
+    Converts source to WAV format, or hard-links it if it already is in that format.
+    Returns False if the file was neither converted nor linked, so the source
+    should be used directly.
+    """
+    # Output may be a link to the source from an earlier run, never write into it
+    if os.path.exists(output):
+        os.unlink(output)
+
+    if not is_wav_format(source):
+        await to_wav(source, output)
+        return True
+
+    try:
+        os.link(source, output)
+    except OSError:
+        return False
+
+    return True
+
+
 @dataclass
 class InputItem:
     """Class for passing input settings for merging."""
@@ -117,8 +163,9 @@ async def merge(
     output_suffix=".wav",
     overwrite: bool = True,
     filter_complex: str = "anull",
+    only: set[str] = None,
 ):
-    """Merges vocals with effects."""
+    """Merges vocals with effects, optionally only of given lines."""
 
     primary_item = inputs[0]
     silent = []
@@ -197,6 +244,9 @@ async def merge(
                 continue
 
             base_name = name.replace(primary_item.suffix, "")
+
+            if only is not None and line_key(os.path.join(path, name)) not in only:
+                continue
             output = os.path.join(output_path, path, base_name + output_suffix)
 
             if not overwrite and os.path.exists(output):
@@ -0,0 +1,290 @@
+import hashlib
+import json
+import mmap
+import os
+import random
+import shutil
+
+from tqdm import tqdm
+
+import config
+from lib import archive as rdar
+from lib import wolvenkit
+from util import find_files
+
+
+def hash_file(path: str):
+    """Returns sha1 of given file's content."""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def scan_files(input_path: str, known: dict[str, list] = None):
+    """
+    Returns size, mtime and hash of all files in given folder.
+    Hashes of files whose size and mtime match the known state are reused.
+    """
+    known = known or {}
+    files = {}
+
+    for file in tqdm(list(find_files(input_path)), desc="Scanning files", unit="file"):
+        stat = os.stat(os.path.join(input_path, file))
+        old = known.get(file)
+
+        if old is not None and old[0] == stat.st_size and old[1] == stat.st_mtime_ns:
+            files[file] = old
+        else:
+            files[file] = [
+                stat.st_size,
+                stat.st_mtime_ns,
+                hash_file(os.path.join(input_path, file)),
+            ]
+
+    return files
+
+
+def _read_manifest(path: str):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_manifest(path: str, archive: str, base: dict[str, str], files: dict):
+    """Saves hashes of the base archive and last known state of input files."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"archive": archive, "base": base, "files": files}, f)
+
+
+def _get_archive_path(archive: str, output: str):
+    return os.path.join(output, "archive/pc/mod", archive + ".archive")
+
+
+def _link_or_copy(source: str, target: str):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def pack_native(archive: str, input_path: str, output: str, changed: set = None):
+    """
+    Packs given folder into a .archive without WolvenKit.
+    If `changed` files are given, other files are reused from the existing archive.
+    """
+    output_path = _get_archive_path(archive, output)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    base = output_path if changed is not None and os.path.exists(output_path) else None
+    written = rdar.write_archive(input_path, output_path, changed, base)
+
+    tqdm.write(f"Packed {written} files from {input_path} into {output_path}")
+
+
+async def pack_incremental(
+    archive: str,
+    input_path: str,
+    output: str,
+    manifest_path=config.PACK_MANIFEST,
+    native=False,
+):
+    """
+    Packs only files that changed since the last full pack.
+    With the native writer, unchanged files are copied over from the last archive,
+    otherwise changed files are packed by WolvenKit into a delta archive
+    that loads before the base archive, falling back to a full pack when files
+    were removed or too many changed.
+    """
+    delta_name = config.PACK_DELTA_PREFIX + archive + config.PACK_DELTA_SUFFIX
+    delta_path = _get_archive_path(delta_name, output)
+
+    manifest = _read_manifest(manifest_path)
+    base = {}
+    known = {}
+    if (
+        manifest is not None
+        and manifest["archive"] == archive
+        and os.path.exists(_get_archive_path(archive, output))
+    ):
+        base = manifest["base"]
+        known = manifest["files"]
+
+    files = scan_files(input_path, known)
+
+    changed = [file for file, state in files.items() if base.get(file) != state[2]]
+    removed = [file for file in base if file not in files]
+
+    if native:
+        tqdm.write(f"Repacking {len(changed)} changed, {len(removed)} removed files...")
+        pack_native(archive, input_path, output, set(changed) if base else None)
+        _write_manifest(
+            manifest_path,
+            archive,
+            {file: state[2] for file, state in files.items()},
+            files,
+        )
+
+        if os.path.exists(delta_path):
+            os.unlink(delta_path)
+        return
+
+    if (
+        len(base) == 0
+        or len(removed) > 0
+        or len(changed) > len(files) * config.PACK_DELTA_MAX
+    ):
+        tqdm.write(
+            f"Doing a full pack ({len(changed)} changed, {len(removed)} removed files)..."
+        )
+        await wolvenkit.pack_files(archive, input_path, output)
+        _write_manifest(
+            manifest_path,
+            archive,
+            {file: state[2] for file, state in files.items()},
+            files,
+        )
+
+        if os.path.exists(delta_path):
+            os.unlink(delta_path)
+        return
+
+    _write_manifest(manifest_path, archive, base, files)
+
+    if len(changed) == 0:
+        tqdm.write("No files changed since the last full pack.")
+        if os.path.exists(delta_path):
+            os.unlink(delta_path)
+        return
+
+    tqdm.write(f"Packing {len(changed)} changed files into {delta_name}...")
+
+    staging_path = os.path.join(config.PACK_STAGING, delta_name)
+    shutil.rmtree(staging_path, ignore_errors=True)
+    for file in tqdm(changed, desc="Staging changed files", unit="file"):
+        _link_or_copy(os.path.join(input_path, file), os.path.join(staging_path, file))
+
+    await wolvenkit.pack_files(delta_name, staging_path, output)
+
+
+def _make_fixtures(path: str, count=64):
+    """Creates a folder of random files that look like the mod's output."""
+    shutil.rmtree(path, ignore_errors=True)
+    rand = random.Random(2077)
+    for i in range(count):
+        folder = os.path.join(path, "base/localization/en-us/vo", f"folder_{i % 4}")
+        os.makedirs(folder, exist_ok=True)
+        size = rand.choice((1, 16, 4096, 65536)) * rand.randint(1, 32)
+        with open(os.path.join(folder, f"v_fixture_f_{i:04x}.wem"), "wb") as f:
+            f.write(rand.randbytes(size))
+
+
+def _read_entry(entry: rdar.ArchiveEntry):
+    with (
+        open(entry.archive, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+    ):
+        return data[entry.offset : entry.offset + entry.zsize]
+
+
+def _compare_layouts(expected: rdar.ArchiveLayout, actual: rdar.ArchiveLayout):
+    """Returns differences in header and index fields of two archives."""
+    differences = []
+
+    for name, layout in (("WolvenKit", expected), ("native", actual)):
+        if layout.file_size != layout.disk_size:
+            differences.append(
+                f"{name} header: file size {layout.file_size}"
+                + f" but the file has {layout.disk_size} bytes"
+            )
+        # A mismatch in WolvenKit's archive means the CRC covers something else
+        if layout.crc != layout.tables_crc:
+            differences.append(
+                f"{name} index: CRC {layout.crc:016x}"
+                + f" but its tables have {layout.tables_crc:016x}"
+            )
+
+    for field in (
+        "version",
+        "debug_size",
+        "table_offset",
+        "file_count",
+        "segment_count",
+        "dependency_count",
+        "data_start",
+        "alignment",
+    ):
+        wanted = getattr(expected, field)
+        got = getattr(actual, field)
+        if got != wanted:
+            differences.append(f"{field}: {got} != {wanted}")
+
+    # Sizes differ with the file count, what the table size counts must not
+    wanted = expected.index_size - expected.table_size
+    got = actual.index_size - actual.table_size
+    if got != wanted:
+        differences.append(f"index size - table size: {got} != {wanted}")
+
+    for name_hash in expected.files.keys() & actual.files.keys():
+        wanted_time, *wanted = expected.files[name_hash]
+        got_time, *got = actual.files[name_hash]
+        if got != wanted:
+            differences.append(
+                f"{name_hash}: buffers, segments and dependencies {got} != {wanted}"
+            )
+        # Timestamps are in 100 ns, allow for file systems that round mtime
+        if abs(got_time - wanted_time) > 20_000_000:
+            differences.append(f"{name_hash}: timestamp {got_time} != {wanted_time}")
+
+    return differences
+
+
+async def verify_native_pack(folder: str = None):
+    """
+    Packs a folder (synthetic fixtures by default) with both WolvenKit
+    and the native writer and compares the resulting archives:
+    header and index fields, the CRC of the index, data offset alignment,
+    file timestamps and segments, and the file tables and raw contents.
+    Returns list of differences.
+    """
+    work_path = os.path.join(config.TMP_PATH, "verify_pack")
+    if folder is None:
+        folder = os.path.join(work_path, "fixtures")
+        _make_fixtures(folder)
+
+    await wolvenkit.pack_files("wolvenkit", folder, work_path)
+    pack_native("native", folder, work_path)
+
+    expected_path = _get_archive_path("wolvenkit", work_path)
+    actual_path = _get_archive_path("native", work_path)
+    expected = {entry.hash: entry for entry in rdar.read_archive(expected_path)}
+    actual = {entry.hash: entry for entry in rdar.read_archive(actual_path)}
+
+    differences = _compare_layouts(
+        rdar.read_layout(expected_path), rdar.read_layout(actual_path)
+    )
+    for name_hash in expected.keys() - actual.keys():
+        differences.append(f"{name_hash}: missing in native archive")
+    for name_hash in actual.keys() - expected.keys():
+        differences.append(f"{name_hash}: not in WolvenKit archive")
+
+    for name_hash in expected.keys() & actual.keys():
+        wanted = expected[name_hash]
+        got = actual[name_hash]
+        if wanted.size != got.size:
+            differences.append(f"{name_hash}: size {got.size} != {wanted.size}")
+        elif wanted.is_raw and (
+            wanted.sha1 != got.sha1 or _read_entry(wanted) != _read_entry(got)
+        ):
+            differences.append(f"{name_hash}: content differs")
+
+    tqdm.write(
+        f"Compared {len(expected)} WolvenKit entries with {len(actual)} native entries, "
+        + f"found {len(differences)} differences."
+    )
+    return differences
@@ -0,0 +1,94 @@
+import os
+import random
+from collections import defaultdict
+
+from tqdm import tqdm
+
+import config
+from lib import ffmpeg
+from util import Parallel, find_files
+
+
+def _round_robin(groups: list[list]):
+    """Takes one item from each group in turn until all are empty."""
+    groups = [list(group) for group in groups if len(group) > 0]
+    result = []
+    while len(groups) > 0:
+        for group in groups:
+            result.append(group.pop(0))
+        groups = [group for group in groups if len(group) > 0]
+    return result
+
+
+def _get_bins(values: list[float], bins: int):
+    """Returns bin of each value, all bins having about the same number of values."""
+    order = sorted(range(len(values)), key=values.__getitem__)
+    result = [0] * len(values)
+    for rank, i in enumerate(order):
+        result[i] = rank * bins // len(values)
+    return result
+
+
+def _by_folder(files: list[str], rand: random.Random):
+    folders = defaultdict(list)
+    for file in files:
+        folders[os.path.dirname(file)].append(file)
+
+    groups = [folders[folder] for folder in sorted(folders)]
+    for group in groups:
+        rand.shuffle(group)
+    rand.shuffle(groups)
+    return groups
+
+
+async def pick_lines(input_path: str, count: int, seed=2077):
+    """
+    Picks a representative sample of files, stratified by folder, duration and loudness.
+    Only a few candidates from every folder are probed, not all files.
+    Returns list of files with their probed volumes and duration.
+    """
+    rand = random.Random(seed)
+    candidates = _round_robin(_by_folder(list(find_files(input_path)), rand))
+    candidates = candidates[: count * config.PREVIEW_CANDIDATES]
+
+    probes = {}
+    parallel = Parallel("Probing candidates")
+
+    async def probe(file: str):
+        try:
+            probes[file] = await ffmpeg.probe_volume(os.path.join(input_path, file))
+        except IndexError:
+            tqdm.write(f"Skipping {file}, it has no audio.")
+
+    for file in candidates:
+        parallel.run(probe, file)
+    await parallel.wait()
+
+    files = [file for file in candidates if file in probes]
+    if len(files) == 0:
+        return []
+
+    durations = _get_bins(
+        [probes[file]["duration"] for file in files], config.PREVIEW_BINS
+    )
+    volumes = _get_bins([probes[file]["mean"] for file in files], config.PREVIEW_BINS)
+
+    strata = defaultdict(list)
+    for file, duration, volume in zip(files, durations, volumes):
+        strata[duration, volume].append(file)
+
+    picked = _round_robin(
+        _round_robin(_by_folder(strata[key], rand)) for key in sorted(strata)
+    )
+    return [(file, probes[file]) for file in picked[:count]]
+
+
+def write_playlist(path: str, entries: list[tuple[str, dict]]):
+    """Writes an m3u playlist of given files relative to the playlist."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("#EXTM3U\n")
+        for file, probe in entries:
+            f.write(
+                f"#EXTINF:{round(probe['duration'])},{file} ({probe['mean']:.1f} dB)\n"
+            )
+            f.write(file.replace("\\", "/") + "\n")
@@ -1,13 +1,29 @@
 import asyncio
+import json
 import os
+import random
 import shutil
-from itertools import chain
+import socket
+import time
+from itertools import chain, product
 
 from tqdm import tqdm
 
 import config
 import lib.ffmpeg as ffmpeg
-from util import Parallel, SubprocessException, find_files, spawn
+from util import Parallel, SubprocessException, find_files, spawn, watch_async
+from util.tuning import get_tuning
+
+
+def _apply_tuning(kwargs: dict):
+    """Fills the worker and thread counts found by `autotune` in, unless given."""
+    tuning = get_tuning("rvc") or {}
+    kwargs["batchsize"] = tuning.get("workers")
+    # The arguments are passed even when not given, as None
+    if kwargs.get("num_threads") is None:
+        kwargs["num_threads"] = tuning.get("threads")
+    if kwargs.get("interop_threads") is None:
+        kwargs["interop_threads"] = tuning.get("interop_threads")
 
 
 async def _poetry_get_venv(path: str):
@@ -189,29 +205,261 @@ def _get_output_filename(filename: str, model: str, instrument=False):
     return f"{prefix}_{filename}_{agg}.wav"
 
 
-async def batch_rvc(input_path: str, opt_path: str, overwrite: bool, **kwargs):
-    """Run RVC over given folder."""
+async def _connect_server():
+    if hasattr(socket, "AF_UNIX"):
+        return await asyncio.open_unix_connection(
+            os.path.join(os.getcwd(), config.RVC_SERVER_SOCKET)
+        )
+    return await asyncio.open_connection("127.0.0.1", config.RVC_SERVER_PORT)
+
+
+async def _submit_to_server(argv: list[str]):
+    """Runs the job on the RVC server, returns False if it isn't running."""
+    try:
+        reader, writer = await _connect_server()
+    except OSError:
+        return False
 
+    pbar = None
+    try:
+        writer.write((json.dumps({"argv": argv}) + "\n").encode())
+        await writer.drain()
+
+        while line := await reader.readline():
+            message = json.loads(line)
+            if "error" in message:
+                raise SubprocessException(f"RVC server failed: {message['error']}")
+
+            if "total" in message:
+                pbar = tqdm(desc="Revoicing", total=message["total"], unit="file")
+            elif "done" in message:
+                pbar.update(message["done"])
+            elif message.get("finished"):
+                tqdm.write(
+                    f"Revoiced {message['seconds'] / 60:.1f} min of audio"
+                    + f" in {message['elapsed'] / 60:.1f} min."
+                )
+                return True
+    finally:
+        writer.close()
+        if pbar is not None:
+            pbar.close()
+
+    raise SubprocessException("RVC server closed the connection.")
+
+
+async def run_server(**kwargs):
+    """
+    Runs the RVC server until it's stopped, `batch_rvc` with `server` then uses it.
+    Without `batchsize`, the settings found by `autotune` are used.
+    """
     cwd = os.getcwd()
 
-    tqdm.write("Starting RVC...")
+    if kwargs.get("batchsize") is None:
+        _apply_tuning(kwargs)
+
+    process = await spawn(
+        "RVC's venv python",
+        await _get_rvc_executable(),
+        os.path.join(cwd, "libs/rvc_server.py"),
+        *("--socket", os.path.join(cwd, config.RVC_SERVER_SOCKET)),
+        *("--port", str(config.RVC_SERVER_PORT)),
+        *chain(*(("--" + k, str(v)) for k, v in kwargs.items() if v is not None)),
+        cwd=os.getenv("RVC_PATH"),
+    )
+    result = await process.wait()
+
+    if result != 0:
+        raise SubprocessException(f"RVC server exited with code {result}")
+
+
+async def stop_server():
+    """Stops the RVC server after its current job."""
+    try:
+        reader, writer = await _connect_server()
+    except OSError:
+        tqdm.write("RVC server is not running.")
+        return
+
+    writer.write((json.dumps({"command": "stop"}) + "\n").encode())
+    await writer.drain()
+    await reader.readline()
+    writer.close()
+    tqdm.write("RVC server is stopping.")
+
+
+async def _follow_files(
+    input_path: str, suffix: str, files: list[str], stdin: asyncio.StreamWriter
+):
+    """
+    Sends files to RVC as they appear in the folder,
+    until `isolate_vocals` marks it as done.
+    A marker left by an earlier run is ignored, so this may be started first.
+    """
+    started = time.time()
+    os.makedirs(input_path, exist_ok=True)
+    event_queue, observer = watch_async(input_path, recursive=True, moves=True)
+    marker = os.path.join(input_path, config.UVR_DONE_MARKER)
+    wanted = set(files) if files is not None else None
+    sent = set()
+
+    def is_done():
+        try:
+            return os.path.getmtime(marker) >= started
+        except OSError:
+            return False
+
+    if os.path.exists(marker):
+        tqdm.write("Waiting for the next isolate_vocals to finish...")
+
+    def send(file: str):
+        if (
+            not file.endswith(suffix)
+            or os.path.basename(file).startswith(config.UVR_PARTIAL_PREFIX)
+            or (wanted is not None and file not in wanted)
+            or file in sent
+        ):
+            return
+
+        sent.add(file)
+        stdin.write((file + "\n").encode())
+
+    try:
+        for file in find_files(input_path, suffix):
+            send(file)
+
+        while True:
+            try:
+                event = await asyncio.wait_for(event_queue.get(), 1)
+                path = getattr(event, "dest_path", "") or event.src_path
+                send(os.path.relpath(path, input_path))
+            except asyncio.TimeoutError:
+                if is_done():
+                    # Catch up on files whose events were missed
+                    for file in find_files(input_path, suffix):
+                        send(file)
+                    break
+            await stdin.drain()
+    finally:
+        observer.stop()
+        stdin.close()
+
+    tqdm.write(f"Vocals isolated, sent {len(sent)} files to RVC.")
+
+
+async def batch_rvc(
+    input_path: str,
+    opt_path: str,
+    overwrite: bool,
+    files: list[str] = None,
+    server=False,
+    follow=False,
+    **kwargs,
+):
+    """
+    Run RVC over given folder, or only given files in it.
+    Without `batchsize`, the settings found by `autotune` are used.
+    With `server`, the job runs on the RVC server if it's running.
+    With `follow`, files are revoiced as `isolate_vocals` writes them, until it ends.
+    """
+
+    cwd = os.getcwd()
+
+    for cache, path in (
+        ("feature_cache", config.RVC_FEATURE_CACHE),
+        ("f0_cache", config.RVC_F0_CACHE),
+    ):
+        if kwargs.get(cache):
+            kwargs[cache] = os.path.join(cwd, path)
+        else:
+            kwargs.pop(cache, None)
+
+    if kwargs.get("batchsize") is None and not (server and not follow):
+        _apply_tuning(kwargs)
 
     _input_path = os.path.join(cwd, input_path)
     _opt_path = os.path.join(cwd, opt_path)
 
     os.makedirs(_opt_path, exist_ok=True)
 
-    process = await spawn(
-        "RVC's venv python",
-        await _get_rvc_executable(),
-        os.path.join(cwd, "libs/infer_batch_rvc.py"),
+    if files is not None and not follow:
+        os.makedirs(config.TMP_PATH, exist_ok=True)
+        file_list = os.path.join(cwd, config.TMP_PATH, "rvc_files.json")
+        with open(file_list, "w", encoding="utf-8") as f:
+            json.dump(files, f)
+        kwargs["file_list"] = file_list
+
+    argv = [
         *("--input_path", _input_path),
         *("--opt_path", _opt_path),
         "--overwrite" if overwrite else "--no-overwrite",
         *chain(*(("--" + k, str(v)) for k, v in kwargs.items() if v is not None)),
+    ]
+
+    if follow:
+        if server:
+            tqdm.write("WARNING: --follow doesn't use the RVC server, starting RVC.")
+        argv.extend(("--stdin_feed", "True"))
+    elif server:
+        if await _submit_to_server(argv):
+            return
+        tqdm.write("RVC server is not running, start it with `rvc_server`.")
+
+    tqdm.write("Starting RVC...")
+
+    process = await spawn(
+        "RVC's venv python",
+        await _get_rvc_executable(),
+        os.path.join(cwd, "libs/infer_batch_rvc.py"),
+        *argv,
         cwd=os.getenv("RVC_PATH"),
+        stdin=asyncio.subprocess.PIPE if follow else None,
     )
+    if follow:
+        await _follow_files(
+            _input_path, kwargs.get("suffix") or ".wav", files, process.stdin
+        )
     result = await process.wait()
 
     if result != 0:
         raise SubprocessException(f"Revoicing files failed with exit code {result}")
+
+
+async def sweep_rvc(
+    input_path: str,
+    sweep: list[tuple[str, list]],
+    sweep_sample: int = None,
+    sweep_path: str = None,
+    suffix: str = None,
+    **kwargs,
+):
+    """
+    Revoices a sample of files with every combination of given settings' values.
+    Each combination is written into its own folder, listed in `sweep.json`.
+    """
+    files = sorted(find_files(input_path, suffix))
+    files = random.Random(2077).sample(
+        files, min(sweep_sample or config.RVC_SWEEP_SAMPLE, len(files))
+    )
+    if len(files) == 0:
+        tqdm.write("No files to sweep.")
+        return
+
+    keys = [key for key, _ in sweep]
+    combinations = [
+        dict(zip(keys, values)) for values in product(*(values for _, values in sweep))
+    ]
+
+    os.makedirs(config.TMP_PATH, exist_ok=True)
+    sweep_file = os.path.join(os.getcwd(), config.TMP_PATH, "rvc_sweep.json")
+    with open(sweep_file, "w", encoding="utf-8") as f:
+        json.dump(combinations, f)
+
+    output_path = sweep_path or config.RVC_SWEEP_OUTPUT
+    tqdm.write(
+        f"Sweeping {len(combinations)} combinations over {len(files)} files"
+        + f" into {output_path}..."
+    )
+    await batch_rvc(
+        input_path, output_path, True, files, sweep=sweep_file, suffix=suffix, **kwargs
+    )
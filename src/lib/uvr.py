@@ -1,22 +1,28 @@
 import asyncio
+import json
 import os
+import tempfile
+import time
+from dataclasses import dataclass
 from functools import partial
 import logging
 from inspect import currentframe, getframeinfo
 import ctypes
-from typing import TYPE_CHECKING
-from queue import Empty
+import gc
+from queue import Empty, SimpleQueue
 from librosa.util.exceptions import ParameterError
+import numpy as np
+import psutil
+import soundfile as sf
+import torch
 from torch.multiprocessing import Process, Queue, JoinableQueue, Value
 from tqdm import tqdm
 import config
 from util import Parallel, find_files
+from util.dirty import line_key
+from util.tuning import get_tuning
 import lib.ffmpeg as ffmpeg
 
-if TYPE_CHECKING:
-    from audio_separator.separator import Separator
-
-
 old_tqdm_init = tqdm.__init__
 
 
@@ -32,156 +38,914 @@ def new_tqdm_init(*args, **kwargs):
 tqdm.__init__ = new_tqdm_init
 
 
+def _partial_path(path: str):
+    """Where a file is written before being renamed, so it never appears half-written."""
+    return os.path.join(
+        os.path.dirname(path), config.UVR_PARTIAL_PREFIX + os.path.basename(path)
+    )
+
+
+def _write_audio(model_instance, path: str, source):
+    partial_path = _partial_path(path)
+    model_instance.write_audio(partial_path, source)
+    os.replace(partial_path, path)
+
+
+def mark_done(output_path: str, done=True):
+    """Marks whether all files in the folder are written, see `revoice --follow`."""
+    marker = os.path.join(output_path, config.UVR_DONE_MARKER)
+    if done:
+        os.makedirs(output_path, exist_ok=True)
+        open(marker, "w", encoding="utf-8").close()
+    elif os.path.exists(marker):
+        os.unlink(marker)
+
+
 def _custom_final_process(
-    output_path: str, filename: str, self, _stem_path, source, stem_name
+    output_path: str,
+    filename: str,
+    stems: dict,
+    skip: str,
+    self,
+    _stem_path,
+    source,
+    stem_name,
 ):
-    os.makedirs(output_path, exist_ok=True)
-    self.write_audio(
-        os.path.join(output_path, f"{filename}_{stem_name.lower()}.wav"),
-        source,
-    )
+    suffix = f"_{stem_name.lower()}.wav"
+    stems[suffix] = source
+
+    if output_path is not None and suffix != skip:
+        os.makedirs(output_path, exist_ok=True)
+        _write_audio(self, os.path.join(output_path, filename + suffix), source)
 
     return {stem_name: source}
 
 
-class UVRProcess(Process):
-    """Process for running UVR"""
+def _prepare_mix(self, mix, _path):
+    """Feeds audio from memory to the model instead of reading given file."""
+    return type(self).prepare_mix(self, mix)
 
-    def __init__(self, queue: Queue = None, progress: Value = None, **kwargs):
-        Process.__init__(self, **kwargs)
 
-        self._run = Value(ctypes.c_bool, False)
-        self._queue = queue or JoinableQueue()
-        self._progress = progress or Value(ctypes.c_int, 0)
-        self._last_model = None
-        self._separator = None
+def _read_clip(path: str):
+    """Reads audio file as a stereo (samples, channels) array."""
+    audio, _sr = sf.read(path, dtype="float32", always_2d=True)
+    if audio.shape[1] == 1:
+        audio = np.repeat(audio, 2, axis=1)
+    return audio
+
+
+def _concat_clips(clips: list):
+    """Joins clips with silence in between, returns the mix and offsets of the clips."""
+    gap = np.zeros((int(config.UVR_BATCH_GAP * 44100), 2), dtype=np.float32)
+    parts = []
+    offsets = []
+    offset = 0
+
+    for clip in clips:
+        offsets.append(offset)
+        parts += [clip, gap]
+        offset += len(clip) + len(gap)
+
+    return np.concatenate(parts), offsets
+
 
-    def _separate(self, input_path: str, output_path: str, file: str, attempt=0):
+def load_shared_weights(models: list[str]):
+    """
+    Loads weights of torch models into shared memory so that CPU workers can use
+    them without having their own copy.
+    ONNX models run in their own runtime and can't be shared.
+    """
+    weights = {}
+
+    for model in models:
+        path = os.path.join(config.UVR_MODEL_CACHE, model)
+        # Not downloaded yet, the workers will download it
+        if not model.endswith(".pth") or not os.path.exists(path):
+            continue
+
+        state = torch.load(path, map_location="cpu")
+        for tensor in state.values():
+            tensor.share_memory_()
+        weights[model] = state
+
+    return weights
+
+
+@dataclass
+class UVRResult:
+    """Completion record of a file processed by a worker."""
+
+    file: str
+    model: str
+    duration: float
+    error: str = None
+    # "transient" or "input"
+    kind: str = None
+    # The task to retry
+    task: tuple = None
+    # Whether it failed in a batch with other files
+    batched: bool = False
+
+
+def _classify_error(error: Exception):
+    """Tells apart errors that may go away on retry from errors caused by the file."""
+    if isinstance(error, MemoryError) or "out of memory" in str(error).lower():
+        return "transient"
+    if "alloc" in str(error).lower():
+        return "transient"
+    return "input"
+
+
+def load_quarantine():
+    """Returns files that failed too many times, with their errors."""
+    try:
+        with open(config.UVR_QUARANTINE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _create_separator():
+    from audio_separator.separator import Separator
+
+    return Separator(
+        log_level=logging.WARNING,
+        model_file_dir=config.UVR_MODEL_CACHE,
+        mdx_params={
+            "hop_length": 1024,
+            "segment_size": 512,
+            "overlap": 0.5,
+            "batch_size": 1,
+            "enable_denoise": True,
+        },
+        vr_params={
+            "batch_size": 4,
+            "window_size": 320,
+            "aggression": 5,
+            "enable_tta": False,
+            "enable_post_process": False,
+            "post_process_threshold": 0.2,
+            "high_end_process": False,
+        },
+    )
+
+
+def _quantize_model(model_instance, model: str):
+    """
+    Swaps the loaded model for a dynamically quantized int8 one,
+    returns whether there was anything to quantize.
+    Torch models get their linear and LSTM layers quantized, convolutions stay float,
+    so convolution-only VR models are left as they are. ONNX models run by
+    ONNX Runtime are quantized once into the model cache and run with all graph
+    optimizations.
+    """
+    model_run = model_instance.model_run
+
+    if isinstance(model_run, torch.nn.Module):
+        layers = (torch.nn.Linear, torch.nn.LSTM)
+        if not any(isinstance(module, layers) for module in model_run.modules()):
+            tqdm.write(
+                f"WARNING: {model} has no linear or LSTM layers, it stays in float32."
+            )
+            return False
+
+        # In place, so that other layers keep using the shared weights
+        torch.ao.quantization.quantize_dynamic(
+            model_run, set(layers), dtype=torch.qint8, inplace=True
+        )
+        return True
+
+    import onnxruntime as ort
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    path = os.path.join(
+        config.UVR_MODEL_CACHE, os.path.splitext(model)[0] + ".int8.onnx"
+    )
+    if not os.path.exists(path):
+        # Other workers may be quantizing too
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        quantize_dynamic(
+            os.path.join(config.UVR_MODEL_CACHE, model),
+            tmp_path,
+            weight_type=QuantType.QInt8,
+        )
+        os.replace(tmp_path, path)
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    model_instance.model_run = lambda spek: session.run(
+        None, {"input": spek.cpu().numpy()}
+    )[0]
+    return True
+
+
+class UVRProcess(Process):
+    """Process for running UVR with given models, in order of the pipeline."""
+
+    def __init__(
+        self,
+        queues: dict[str, JoinableQueue],
+        results: Queue,
+        models: list[str],
+        batch_size=1,
+        shared_weights: dict = None,
+        threads: int = None,
+        interop_threads: int = None,
+        quantize=False,
+        **kwargs,
+    ):
+        Process.__init__(self, **kwargs)
+
+        self.models = list(models)
+        self.batch_size = batch_size
+        self.quantize = quantize
+        self._shared_weights = shared_weights or {}
+        self._threads = threads
+        self._interop_threads = interop_threads
+        self._run = Value(ctypes.c_bool, True)
+        self._queues = queues
+        self._results = results
+        self._separators = {}
+        # Models that actually run quantized
+        self.quantized = set()
+
+    def _separate(
+        self,
+        model: str,
+        input_path: str,
+        output_path: str,
+        file: str,
+        mix=None,
+        skip: str = None,
+        attempt=0,
+    ):
+        """
+        Separates given file and returns its stems by suffix.
+        If `mix` is given, it's separated instead of the file's content.
+        Stem with the `skip` suffix is not written to disk.
+        """
         dirname = os.path.dirname(file)
         filename = os.path.basename(file)
+        model_instance = self._separators[model].model_instance
+        stems = {}
 
-        self._separator.model_instance.final_process = partial(
+        model_instance.final_process = partial(
             _custom_final_process,
-            os.path.join(output_path, dirname),
+            None if output_path is None else os.path.join(output_path, dirname),
             filename,
-            self._separator.model_instance,
+            stems,
+            skip,
+            model_instance,
         )
 
+        if mix is None:
+            model_instance.__dict__.pop("prepare_mix", None)
+        else:
+            model_instance.prepare_mix = partial(_prepare_mix, model_instance, mix)
+
         try:
-            return self._separator.separate(os.path.join(input_path, file))
+            self._separators[model].separate(os.path.join(input_path, file))
+            return stems
         except ParameterError:
             if attempt < 3:
-                return self._separate(input_path, output_path, file, attempt + 1)
+                return self._separate(
+                    model, input_path, output_path, file, mix, skip, attempt + 1
+                )
             raise
 
+    def _separate_chained(
+        self, model: str, input_path: str, output_path: str, file: str, next_path: str
+    ):
+        """Separates the file and passes its vocals to the next model in memory."""
+        start = time.monotonic()
+        stems = self._separate(
+            model, input_path, output_path, file, skip=config.UVR_FIRST_SUFFIX
+        )
+        self._results.put(UVRResult(file, model, time.monotonic() - start))
+
+        next_model = self.models[self.models.index(model) + 1]
+        next_file = file + config.UVR_FIRST_SUFFIX
+        vocals = stems[config.UVR_FIRST_SUFFIX]
+        start = time.monotonic()
+        try:
+            # The input file is only used for naming, the vocals are fed from memory
+            self._separate(next_model, input_path, next_path, next_file, mix=vocals)
+        except Exception as e:
+            # Save the vocals so that only the next model has to be retried
+            self._separators[model].model_instance.write_audio(
+                os.path.join(output_path, next_file), vocals
+            )
+            self._report_error(
+                next_model, (output_path, next_path, next_file, None, False), e, start
+            )
+            return
+
+        self._results.put(UVRResult(next_file, next_model, time.monotonic() - start))
+
+    def _write_clips(
+        self,
+        model: str,
+        stems: dict,
+        clips: list,
+        offsets: list,
+        files: list,
+        skip=None,
+    ):
+        """Splits stems of a batch back to files."""
+        model_instance = self._separators[model].model_instance
+
+        for suffix, source in stems.items():
+            if suffix == skip:
+                continue
+
+            for clip, offset, (output_path, file) in zip(clips, offsets, files):
+                output_file = os.path.join(output_path, file + suffix)
+                os.makedirs(os.path.dirname(output_file), exist_ok=True)
+                _write_audio(
+                    model_instance, output_file, source[offset : offset + len(clip)]
+                )
+
+    def _separate_batch(self, model: str, tasks: list):
+        """
+        Separates multiple short files in one model call by joining them with silence
+        and splitting the stems back afterwards.
+        """
+        start = time.monotonic()
+        clips = [_read_clip(os.path.join(task[0], task[2])) for task in tasks]
+        mix, offsets = _concat_clips(clips)
+        lengths = np.array([len(clip) for clip in clips])
+        next_path = tasks[0][3]
+
+        os.makedirs(config.TMP_PATH, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=config.TMP_PATH) as tmp_path:
+            # Not every model can take audio from memory, so we give it a file
+            sf.write(os.path.join(tmp_path, "batch.wav"), mix, 44100)
+            stems = self._separate(model, tmp_path, None, "batch.wav")
+
+        skip = config.UVR_FIRST_SUFFIX if next_path is not None else None
+        files = [(task[1], task[2]) for task in tasks]
+        self._write_clips(model, stems, clips, offsets, files, skip)
+
+        elapsed = time.monotonic() - start
+        for task, length in zip(tasks, lengths):
+            self._results.put(
+                UVRResult(task[2], model, elapsed * length / lengths.sum())
+            )
+
+        if next_path is None:
+            return
+
+        # The vocals of the batch are already joined, feed them to the next model
+        next_model = self.models[self.models.index(model) + 1]
+        start = time.monotonic()
+        try:
+            next_stems = self._separate(
+                next_model,
+                tmp_path,
+                None,
+                "batch.wav",
+                mix=stems[config.UVR_FIRST_SUFFIX],
+            )
+        except Exception as e:
+            # Save the vocals so that only the next model has to be retried
+            vocals = {config.UVR_FIRST_SUFFIX: stems[config.UVR_FIRST_SUFFIX]}
+            self._write_clips(model, vocals, clips, offsets, files)
+            for task in tasks:
+                next_file = task[2] + config.UVR_FIRST_SUFFIX
+                self._report_error(
+                    next_model,
+                    (task[1], task[3], next_file, None, False),
+                    e,
+                    start,
+                    len(tasks) > 1,
+                )
+            return
+
+        files = [(task[3], task[2] + config.UVR_FIRST_SUFFIX) for task in tasks]
+        self._write_clips(next_model, next_stems, clips, offsets, files)
+
+        elapsed = time.monotonic() - start
+        for file, length in zip(files, lengths):
+            self._results.put(
+                UVRResult(file[1], next_model, elapsed * length / lengths.sum())
+            )
+
+    def _get_batch(self, model: str, tasks: list):
+        """
+        Adds more short files of the same kind from the queue of given model to `tasks`.
+        Files that can't be read are reported right away.
+        Files retried after a failed batch are processed alone.
+        """
+        task = tasks[0]
+        if task[4]:
+            return
+
+        duration = sf.info(os.path.join(task[0], task[2])).duration
+
+        while len(tasks) < self.batch_size and duration < config.UVR_BATCH_SECONDS:
+            try:
+                next_task = self._queues[model].get_nowait()
+            except Empty:
+                break
+
+            start = time.monotonic()
+            try:
+                next_duration = sf.info(
+                    os.path.join(next_task[0], next_task[2])
+                ).duration
+            except Exception as e:
+                self._report_error(model, next_task, e, start)
+                self._queues[model].task_done()
+                continue
+
+            # Can't batch chained and plain files together, nor too long or retried files
+            if (
+                next_task[4]
+                or (next_task[3] is None) != (task[3] is None)
+                or duration + next_duration > config.UVR_BATCH_SECONDS
+            ):
+                # give it back
+                self._queues[model].put(next_task)
+                self._queues[model].task_done()
+                break
+
+            tasks.append(next_task)
+            duration += next_duration
+
+    def _separate_long(
+        self, model: str, input_path: str, output_path: str, file: str, next_path: str
+    ):
+        """
+        Separates a long file in overlapping windows that are crossfaded together,
+        so that memory use doesn't depend on the file's length.
+        """
+        window = int(config.UVR_CHUNK_SECONDS * 44100)
+        overlap = int(config.UVR_CHUNK_OVERLAP * 44100)
+        writers = {}
+        tails = {}
+
+        os.makedirs(config.TMP_PATH, exist_ok=True)
+        try:
+            with (
+                sf.SoundFile(os.path.join(input_path, file)) as audio,
+                tempfile.TemporaryDirectory(dir=config.TMP_PATH) as tmp_path,
+            ):
+                start = 0
+                while True:
+                    audio.seek(start)
+                    clip = audio.read(window, dtype="float32", always_2d=True)
+                    if clip.shape[1] == 1:
+                        clip = np.repeat(clip, 2, axis=1)
+                    last = start + len(clip) >= audio.frames
+
+                    # Not every model can take audio from memory, so we give it a file
+                    sf.write(os.path.join(tmp_path, "chunk.wav"), clip, 44100)
+                    stems = self._separate(model, tmp_path, None, "chunk.wav")
+
+                    for suffix, source in stems.items():
+                        source = np.array(source[: len(clip)], dtype=np.float32)
+
+                        tail = tails.get(suffix)
+                        if tail is not None:
+                            n = min(len(tail), len(source))
+                            fade = np.linspace(0, 1, n, dtype=np.float32)[:, None]
+                            source[:n] = tail[:n] * (1 - fade) + source[:n] * fade
+
+                        if suffix not in writers:
+                            output_file = os.path.join(output_path, file + suffix)
+                            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+                            writers[suffix] = sf.SoundFile(
+                                _partial_path(output_file), "w", 44100, 2, "PCM_16"
+                            )
+
+                        if last:
+                            writers[suffix].write(source)
+                        else:
+                            # The end is written crossfaded with the next window
+                            writers[suffix].write(source[:-overlap])
+                            tails[suffix] = source[-overlap:]
+
+                    if last:
+                        break
+                    start += window - overlap
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        for suffix in writers:
+            output_file = os.path.join(output_path, file + suffix)
+            os.replace(_partial_path(output_file), output_file)
+
+        if next_path is not None:
+            # The vocals are on disk already, let the next model take them from there
+            next_model = self.models[self.models.index(model) + 1]
+            self._queues[next_model].put(
+                (output_path, next_path, file + config.UVR_FIRST_SUFFIX, None)
+            )
+
+    def _report_error(
+        self, model: str, task: tuple, error: Exception, start: float, batched=False
+    ):
+        """
+        Sends the failure to the manager, which decides whether to retry it.
+        `batched` tells that the file failed together with others.
+        """
+        kind = _classify_error(error)
+        if kind == "transient":
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+        self._results.put(
+            UVRResult(
+                task[2],
+                model,
+                time.monotonic() - start,
+                repr(error),
+                kind,
+                task,
+                batched,
+            )
+        )
+
+    def load_models(self):
+        """Loads all models of this worker."""
+        for model in self.models:
+            self._separators[model] = _create_separator()
+            self._separators[model].load_model(model)
+
+            model_instance = self._separators[model].model_instance
+            if (
+                model in self._shared_weights
+                and model_instance.torch_device.type == "cpu"
+            ):
+                # Replace our own copy of weights with the shared ones
+                model_instance.model_run.load_state_dict(
+                    self._shared_weights[model], assign=True
+                )
+
+            if self.quantize:
+                if model_instance.torch_device.type == "cpu":
+                    if _quantize_model(model_instance, model):
+                        self.quantized.add(model)
+                else:
+                    tqdm.write(f"WARNING: Not quantizing {model}, it's not on CPU.")
+
+        gc.collect()
+
+    def _get_task(self):
+        # Prefer later stages to push files through the pipeline
+        for model in reversed(self.models[1:]):
+            try:
+                return model, self._queues[model].get_nowait()
+            except Empty:
+                pass
+
+        try:
+            model = self.models[0]
+            return model, self._queues[model].get(timeout=0.1)
+        except (Empty, TimeoutError):
+            return None, None
+
     def terminate(self):
-        if self._run:
-            self._run = False
+        if self._run.value:
+            self._run.value = False
         else:
             Process.terminate(self)
 
     def run(self):
-        from audio_separator.separator import Separator
-
-        self._separator = Separator(
-            log_level=logging.WARNING,
-            model_file_dir=config.UVR_MODEL_CACHE,
-            mdx_params={
-                "hop_length": 1024,
-                "segment_size": 512,
-                "overlap": 0.5,
-                "batch_size": 1,
-                "enable_denoise": True,
-            },
-            vr_params={
-                "batch_size": 4,
-                "window_size": 320,
-                "aggression": 5,
-                "enable_tta": False,
-                "enable_post_process": False,
-                "post_process_threshold": 0.2,
-                "high_end_process": False,
-            },
-        )
+        if self._threads is not None:
+            torch.set_num_threads(self._threads)
+        if self._interop_threads is not None:
+            torch.set_num_interop_threads(self._interop_threads)
 
-        while self._run:
-            try:
-                input_path, output_path, file, wanted_model = self._queue.get(
-                    timeout=0.1
-                )
-            except (Empty, TimeoutError):
+        self.load_models()
+
+        while self._run.value:
+            model, task = self._get_task()
+            if task is None:
                 continue
 
+            tasks = [task]
+            start = time.monotonic()
             try:
-                # Load new model if needed
-                if wanted_model != self._last_model:
-                    self._separator.load_model(wanted_model)
-                    self._last_model = wanted_model
-
-                # Run separation
-                self._separate(input_path, output_path, file)
-
-                with self._progress.get_lock():
-                    self._progress.value += 1
-            except:
-                # We failed, put the task back (I expect low VRAM, not unparsable file)
-                self._queue.put((input_path, output_path, file, wanted_model))
-                raise
+                if self.batch_size > 1:
+                    self._get_batch(model, tasks)
+                    if len(tasks) > 1:
+                        self._separate_batch(model, tasks)
+                        continue
+
+                input_path, output_path, file, next_path, _solo = task
+                duration = sf.info(os.path.join(input_path, file)).duration
+                if duration > config.UVR_CHUNK_SECONDS:
+                    self._separate_long(model, input_path, output_path, file, next_path)
+                    self._results.put(UVRResult(file, model, time.monotonic() - start))
+                elif next_path is None:
+                    self._separate(model, input_path, output_path, file)
+                    self._results.put(UVRResult(file, model, time.monotonic() - start))
+                else:
+                    self._separate_chained(
+                        model, input_path, output_path, file, next_path
+                    )
+            except Exception as e:
+                # Keep the worker and its model alive, the manager retries the files
+                for failed in tasks:
+                    self._report_error(model, failed, e, start, len(tasks) > 1)
             finally:
-                # but either way we need to mark it done otherwise it would be undone twice
-                self._queue.task_done()
+                # but either way we need to mark them done otherwise they would be undone twice
+                for _task in tasks:
+                    self._queues[model].task_done()
 
 
 class UVRProcessManager:
-    """Manage multiple UVR processes."""
+    """
+    Manage multiple UVR processes.
+    Each model in the pipeline gets its own group of workers, the groups are resized
+    by the measured time per file and the remaining work of each model.
+    A single worker runs all the models.
+    With `in_memory`, every worker has all the models loaded so that stems can be
+    passed between them without writing them to disk.
+    Without a GPU, the workers share weights of torch models and split the CPU cores.
+    Failed files are retried with a backoff, files that keep failing are quarantined.
+    """
+
+    def __init__(
+        self,
+        jobs=1,
+        models=(config.UVR_FIRST_MODEL, config.UVR_SECOND_MODEL),
+        in_memory=False,
+        batch_size=1,
+        threads: int = None,
+        interop_threads: int = None,
+        quantize=False,
+    ):
+        self.models = list(models)
+        self.batch_size = batch_size
+        self.quantize = quantize
+        self._queues = {model: JoinableQueue() for model in self.models}
+        self._results = Queue()
+        self._pending = {model: 0 for model in self.models}
+        self._expected = {model: 0 for model in self.models}
+        self._finished = {model: 0 for model in self.models}
+        self._last_rebalance = time.monotonic()
+        self.durations = {}
+        self.on_result = None
+        self.pbars = {model: tqdm(disable=True) for model in self.models}
+        self.memory = {}
+        self._last_measure = 0
+        self.quarantine = load_quarantine()
+        self._failures = {}
+
+        self._shared_weights = {}
+        self._threads = threads
+        self._interop_threads = interop_threads
+        if not torch.cuda.is_available():
+            self._shared_weights = load_shared_weights(self.models)
+            if self._threads is None:
+                self._threads = max(1, os.cpu_count() // jobs)
+
+        self._workers = set()
+        self._retiring = set()
+
+        if in_memory:
+            for _ in range(jobs):
+                self._spawn(self.models)
+        elif jobs < len(self.models):
+            self._spawn(self.models)
+        else:
+            for i in range(jobs):
+                self._spawn([self.models[i * len(self.models) // jobs]])
+
+    def _spawn(self, models: list[str]):
+        worker = UVRProcess(
+            self._queues,
+            self._results,
+            models,
+            self.batch_size,
+            self._shared_weights,
+            self._threads,
+            self._interop_threads,
+            self.quantize,
+        )
+        worker.start()
+        self._workers.add(worker)
+
+    def submit(
+        self,
+        input_path: str,
+        output_path: str,
+        file: str,
+        model: str = None,
+        next_path: str = None,
+    ):
+        """
+        Submit work to workers, for the first model by default.
+        If `next_path` is given, the vocals are processed by the next model
+        right away and written there.
+        """
+        model = model or self.models[0]
+        self._pending[model] += 1
+        if next_path is not None:
+            self._pending[self.models[self.models.index(model) + 1]] += 1
+        # The last item tells whether the file must be processed alone
+        self._queues[model].put((input_path, output_path, file, next_path, False))
+
+    def expect(self, counts: dict[str, int]):
+        """Sets how many files each model is to finish before `watch` returns."""
+        for model, count in counts.items():
+            self._expected[model] = count
+            self._finished[model] = 0
+            self.pbars[model].reset(count)
 
-    def __init__(self, jobs=1):
-        self._queue = JoinableQueue()
-        self._progress = Value(ctypes.c_int, 0)
-        self._wanted_model = None
+    def wait(self):
+        """Wait for all workers to finish."""
+        for queue in self._queues.values():
+            queue.join()
 
-        self._workers = set(
-            UVRProcess(self._queue, self._progress) for _ in range(jobs)
-        )
-        self.pbar = tqdm(disable=True)
+    def _check_workers(self):
+        for worker in [*self._workers]:
+            if worker.exitcode is not None:
+                self._workers.remove(worker)
+                if worker in self._retiring:
+                    self._retiring.remove(worker)
+                    continue
 
-        for worker in self._workers:
-            worker.start()
+                tqdm.write("WARNING: A worker died, respawning...")
+                self._spawn(worker.models)
 
-    def submit(self, input_path: str, output_path: str, file: str):
-        """Submit work to workers."""
-        if self._wanted_model is None:
-            raise ValueError("No model has been set yet.")
+        self._measure_memory()
 
-        self._queue.put((input_path, output_path, file, self._wanted_model))
+    def _measure_memory(self):
+        """Remembers peak memory usage of each worker."""
+        # Reading full memory info is slow, don't do it too often
+        if time.monotonic() - self._last_measure < 5:
+            return
 
-    def set_model(self, model: str):
-        """Change to loaded model."""
-        self._wanted_model = model
+        self._last_measure = time.monotonic()
 
-    def wait(self):
-        """Wait for all workers to finish."""
-        self._queue.join()
+        for worker in self._workers:
+            try:
+                info = psutil.Process(worker.pid).memory_full_info()
+            except (psutil.Error, ValueError):
+                continue
+
+            rss, uss = self.memory.get(worker.pid, (0, 0))
+            self.memory[worker.pid] = (max(rss, info.rss), max(uss, info.uss))
+
+    def _rebalance(self):
+        """Moves a worker to the model with the most remaining work per worker."""
+        workers = [w for w in self._workers if w not in self._retiring]
+        if len(workers) < len(self.models) or any(len(w.models) > 1 for w in workers):
+            return
+
+        now = time.monotonic()
+        if now - self._last_rebalance < config.UVR_REBALANCE_INTERVAL:
+            return
+
+        if any(len(self.durations.get(model, [])) < 4 for model in self.models):
+            return
+
+        # Work left for a model includes files still in earlier models
+        work = {}
+        files_left = 0
+        for model in self.models:
+            files_left += self._pending[model]
+            durations = self.durations[model][-50:]
+            work[model] = files_left * sum(durations) / len(durations)
+
+        total_work = sum(work.values())
+        if total_work == 0:
+            return
+
+        current = {model: 0 for model in self.models}
+        for worker in workers:
+            current[worker.models[0]] += 1
+
+        wanted = {
+            model: max(
+                1 if work[model] > 0 else 0,
+                round(len(workers) * work[model] / total_work),
+            )
+            for model in self.models
+        }
+
+        short = max(self.models, key=lambda m: wanted[m] - current[m])
+        spare = min(self.models, key=lambda m: wanted[m] - current[m])
+        if wanted[short] - current[short] < 1 or current[spare] - wanted[spare] < 1:
+            return
+
+        self._last_rebalance = now
+        retired = next(w for w in workers if w.models[0] == spare)
+        retired.terminate()
+        self._retiring.add(retired)
+        self._spawn([short])
+
+    def _retry(self, result: UVRResult):
+        """Retries failed file later, or quarantines it if it failed too many times."""
+        if result.batched:
+            # Any file of the batch may be at fault, retry each alone before counting it
+            self._queues[result.model].put((*result.task[:4], True))
+            return
+
+        key = (result.model, result.file)
+        failures = self._failures.get(key, 0) + 1
+        self._failures[key] = failures
+
+        retries = (
+            config.UVR_RETRIES
+            if result.kind == "transient"
+            else config.UVR_INPUT_RETRIES
+        )
+        if failures > retries:
+            tqdm.write(
+                f"Processing {result.file} failed {failures} times, quarantining it: "
+                + result.error
+            )
+            self._quarantine(result)
+            return
+
+        delay = config.UVR_RETRY_DELAY * 2 ** (failures - 1)
+        tqdm.write(
+            f"Processing {result.file} failed ({result.kind}), "
+            + f"retrying in {delay}s: {result.error}"
+        )
+        asyncio.get_running_loop().call_later(
+            delay, self._queues[result.model].put, result.task
+        )
+
+    def _quarantine(self, result: UVRResult):
+        self.quarantine[result.file] = {
+            "model": result.model,
+            "error": result.error,
+            "kind": result.kind,
+        }
+
+        os.makedirs(os.path.dirname(config.UVR_QUARANTINE_PATH), exist_ok=True)
+        with open(config.UVR_QUARANTINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(self.quarantine, f, indent=4)
+
+        index = self.models.index(result.model)
+        self._pending[result.model] -= 1
+        if result.task[3] is not None:
+            self._pending[self.models[index + 1]] -= 1
+
+        # The file won't get to the following models either
+        for model in self.models[index:]:
+            self._finished[model] += 1
+            self.pbars[model].update(1)
+
+    def _handle_result(self, result: UVRResult):
+        if result.error is not None:
+            self._retry(result)
+            return
+
+        self._pending[result.model] -= 1
+        self.durations.setdefault(result.model, []).append(result.duration)
+        self._finished[result.model] += 1
+        self.pbars[result.model].update(1)
+
+        if self.on_result is not None:
+            self.on_result(result)
+
+        self._rebalance()
+
+    def _is_done(self):
+        # Not by the progress bars, disabled ones don't count
+        return all(
+            self._finished[model] >= self._expected[model] for model in self.models
+        )
 
     async def watch(self):
-        """Wait and update the progress asynchronously."""
-        while self.pbar.n < self.pbar.total:
-            # Update progress bar
-            with self._progress.get_lock():
-                self.pbar.update(self._progress.value)
-                self._progress.value = 0
-
-            # Check on workers
-            for worker in [*self._workers]:
-                if worker.exitcode is not None:
-                    tqdm.write("WARNING: A worker died, respawning...")
-                    self._workers.remove(worker)
-                    new_worker = UVRProcess(self._queue, self._progress)
-                    new_worker.start()
-                    self._workers.add(new_worker)
-
-            # TODO: a return queue?
-            await asyncio.sleep(0.01)
+        """Wait for results from workers and update the progress asynchronously."""
+        loop = asyncio.get_running_loop()
+
+        while not self._is_done():
+            try:
+                # Blocks in a thread until a result comes, wakes up to check on workers
+                result = await loop.run_in_executor(None, self._results.get, True, 1)
+                self._handle_result(result)
+            except Empty:
+                pass
+
+            self._check_workers()
+
+    def report(self):
+        """Writes per-file latency of each model."""
+        for model, durations in self.durations.items():
+            durations = sorted(durations)
+            tqdm.write(
+                f"{model}: {len(durations)} files, "
+                + f"mean {sum(durations) / len(durations):.2f}s, "
+                + f"p95 {durations[int(len(durations) * 0.95)]:.2f}s per file"
+            )
+
+        for pid, (rss, uss) in self.memory.items():
+            tqdm.write(
+                f"Worker {pid}: peak RSS {rss / 2**20:.0f} MiB, "
+                + f"of that private {uss / 2**20:.0f} MiB"
+            )
 
     def terminate(self):
         """Terminate all workers."""
@@ -198,9 +962,22 @@ async def isolate_vocals(
     input_path: str,
     cache_path=config.CACHE_PATH,
     overwrite: bool = True,
-    n_workers=1,
+    n_workers: int = None,
+    only: set[str] = None,
+    in_memory=False,
+    batch_size=1,
+    quantize=False,
 ):
-    """Splits audio files to vocals and the rest. The audio has to be correct wav."""
+    """
+    Splits audio files to vocals and the rest. The audio has to be correct wav.
+    Each file goes to dereverb as soon as its vocals are split.
+    If `only` is given, only files of those lines are processed.
+    With `in_memory`, the split vocals go to dereverb without being saved.
+    With `batch_size` over 1, short files are separated together in one model call.
+    Without `n_workers`, the settings found by `autotune` are used.
+    With `quantize`, the models' linear and LSTM layers run in int8 on CPU,
+    see `compare_quantized`.
+    """
     # Prepare paths
     formatted_path = os.path.join(cache_path, config.UVR_FORMAT_CACHE)
     split_path = os.path.join(cache_path, config.UVR_FIRST_CACHE)
@@ -209,6 +986,23 @@ async def isolate_vocals(
     # Load list of files
     files = set(find_files(input_path))
 
+    if only is not None:
+        files = set(file for file in files if line_key(file) in only)
+
+    quarantine = load_quarantine()
+    quarantined = set(
+        file
+        for file in files
+        if file.replace(".ogg", ".wav") in quarantine
+        or file.replace(".ogg", ".wav") + config.UVR_FIRST_SUFFIX in quarantine
+    )
+    if len(quarantined) > 0:
+        files -= quarantined
+        tqdm.write(
+            f"Skipping {len(quarantined)} quarantined files, "
+            + f"remove them from {config.UVR_QUARANTINE_PATH} to retry them."
+        )
+
     if not overwrite:
         skipped = 0
 
@@ -227,10 +1021,38 @@ async def isolate_vocals(
     # Prepare conversion and splitting
     ffmpegs = Parallel("[Phase 1/3] Converting files", leave=True, unit="file")
     split_pbar = tqdm(desc="[Phase 2/3] Separating audio", leave=True, unit="file")
-    uvr_workers = UVRProcessManager(n_workers)
-    uvr_workers.pbar = split_pbar
+    reverb_pbar = tqdm(desc="[Phase 3/3] Removing reverb", leave=True, unit="file")
+    tuning = {}
+    if n_workers is None:
+        tuning = get_tuning("uvr") or {}
+        n_workers = tuning.get("workers", 1)
+
+    uvr_workers = UVRProcessManager(
+        n_workers,
+        in_memory=in_memory,
+        batch_size=batch_size,
+        threads=tuning.get("threads"),
+        interop_threads=tuning.get("interop_threads"),
+        quantize=quantize,
+    )
+    uvr_workers.pbars = {
+        config.UVR_FIRST_MODEL: split_pbar,
+        config.UVR_SECOND_MODEL: reverb_pbar,
+    }
+
+    def submit_dereverb(converted_file: str):
+        uvr_workers.submit(
+            split_path,
+            reverb_path,
+            converted_file + config.UVR_FIRST_SUFFIX,
+            config.UVR_SECOND_MODEL,
+        )
 
-    uvr_workers.set_model(config.UVR_FIRST_MODEL)
+    def on_result(result: UVRResult):
+        if result.model == config.UVR_FIRST_MODEL and not in_memory:
+            submit_dereverb(result.file)
+
+    uvr_workers.on_result = on_result
 
     async def convert_and_process(file: str):
         dirname = os.path.dirname(file)
@@ -238,23 +1060,34 @@ async def isolate_vocals(
 
         converted_file = file.replace(".ogg", ".wav")
         converted_path = os.path.join(formatted_path, converted_file)
+        source_path = formatted_path
         if overwrite or not os.path.exists(converted_path):
-            await ffmpeg.to_wav(os.path.join(input_path, file), converted_path)
-
-        uvr_workers.submit(formatted_path, split_path, converted_file)
+            # Files already in the right format are only linked
+            if not await ffmpeg.to_wav_if_needed(
+                os.path.join(input_path, file), converted_path
+            ):
+                source_path = input_path
+
+        uvr_workers.submit(
+            source_path,
+            split_path,
+            converted_file,
+            next_path=reverb_path if in_memory else None,
+        )
 
     # Run conversion and splitting
     split_files = []
 
     for file in files:
-        output_file = file.replace(".ogg", ".wav") + config.UVR_FIRST_SUFFIX
+        converted_file = file.replace(".ogg", ".wav")
 
         if not overwrite:
-            output = os.path.join(split_path, output_file)
+            output = os.path.join(split_path, converted_file + config.UVR_FIRST_SUFFIX)
             if os.path.exists(output):
+                submit_dereverb(converted_file)
                 continue
 
-        split_files.append(output_file)
+        split_files.append(converted_file)
 
         ffmpegs.run(convert_and_process, file)
 
@@ -263,29 +1096,183 @@ async def isolate_vocals(
     if not overwrite and cached > 0:
         tqdm.write(f"Won't split {cached} already split files.")
 
-    split_pbar.reset(ffmpegs.count_jobs())
+    uvr_workers.expect(
+        {
+            config.UVR_FIRST_MODEL: ffmpegs.count_jobs(),
+            config.UVR_SECOND_MODEL: len(files),
+        }
+    )
 
     await asyncio.gather(ffmpegs.wait(), uvr_workers.watch())
     split_pbar.close()
+    reverb_pbar.close()
 
     tqdm.write("Waiting for workers...")
     uvr_workers.wait()
+    uvr_workers.terminate()
+    uvr_workers.join()
+    uvr_workers.report()
 
-    # Reset workers
-    reverb_pbar = tqdm(
-        total=len(files), desc="[Phase 3/3] Removing reverb", unit="file"
+
+async def measure_throughput(
+    input_path: str,
+    files: list[str],
+    jobs: int,
+    threads: int = None,
+    interop_threads: int = None,
+):
+    """
+    Runs both models over given converted files and returns files per second,
+    not counting the time to start the workers.
+    """
+    output_path = os.path.join(config.TMP_PATH, "autotune_uvr")
+    split_path = os.path.join(output_path, config.UVR_FIRST_CACHE)
+    reverb_path = os.path.join(output_path, config.UVR_SECOND_CACHE)
+
+    uvr_workers = UVRProcessManager(
+        jobs, threads=threads, interop_threads=interop_threads
     )
-    uvr_workers.pbar = reverb_pbar
-    uvr_workers.set_model(config.UVR_SECOND_MODEL)
 
-    for file in files:
-        input_file = file.replace(".ogg", ".wav") + config.UVR_FIRST_SUFFIX
-        uvr_workers.submit(split_path, reverb_path, input_file)
+    def on_result(result: UVRResult):
+        if result.model == config.UVR_FIRST_MODEL:
+            uvr_workers.submit(
+                split_path,
+                reverb_path,
+                result.file + config.UVR_FIRST_SUFFIX,
+                config.UVR_SECOND_MODEL,
+            )
 
-    await uvr_workers.watch()
-    split_pbar.close()
+    uvr_workers.on_result = on_result
 
-    tqdm.write("Waiting for workers...")
-    uvr_workers.wait()
-    uvr_workers.terminate()
-    uvr_workers.join()
+    async def run(files: list[str]):
+        uvr_workers.expect({model: len(files) for model in uvr_workers.models})
+        for file in files:
+            uvr_workers.submit(input_path, split_path, file)
+        await uvr_workers.watch()
+
+    try:
+        # Warm up, so that all workers have their models loaded
+        await run(files[:jobs])
+
+        start = time.monotonic()
+        await run(files[jobs:])
+        return (len(files) - jobs) / (time.monotonic() - start)
+    finally:
+        uvr_workers.terminate()
+        uvr_workers.join()
+
+
+def benchmark_batching(
+    input_path: str,
+    batch_sizes=(1, 2, 4, 8, 16),
+    count=32,
+    model=config.UVR_FIRST_MODEL,
+):
+    """Measures separation throughput of short files on CPU for given batch sizes."""
+    # Hide GPUs before the separator looks for them
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+    files = sorted(find_files(input_path, ".wav"))[:count]
+    if len(files) == 0:
+        tqdm.write("No files to benchmark.")
+        return
+
+    audio_seconds = sum(
+        sf.info(os.path.join(input_path, file)).duration for file in files
+    )
+    tqdm.write(f"Benchmarking {len(files)} files, {audio_seconds:.1f}s of audio...")
+
+    worker = UVRProcess({model: JoinableQueue()}, SimpleQueue(), [model])
+    worker.load_models()
+
+    # Warm up
+    worker._separate(model, input_path, None, files[0])
+
+    results = {}
+    for batch_size in batch_sizes:
+        output_path = os.path.join(config.TMP_PATH, "benchmark_uvr", str(batch_size))
+        start = time.monotonic()
+
+        for i in range(0, len(files), batch_size):
+            tasks = [
+                (input_path, output_path, file, None)
+                for file in files[i : i + batch_size]
+            ]
+            if len(tasks) == 1:
+                worker._separate(model, input_path, output_path, tasks[0][2])
+            else:
+                worker._separate_batch(model, tasks)
+
+        elapsed = time.monotonic() - start
+        results[batch_size] = elapsed
+        tqdm.write(
+            f"Batch size {batch_size}: {len(files) / elapsed:.2f} files/s, "
+            + f"{audio_seconds / elapsed:.2f}x real-time"
+        )
+
+    return results
+
+
+def _snr(reference, signal):
+    """Signal-to-noise ratio of a signal against its reference, in dB."""
+    length = min(len(reference), len(signal))
+    noise = np.sum((reference[:length] - signal[:length]) ** 2)
+    if noise == 0:
+        return float("inf")
+    return 10 * np.log10(np.sum(reference[:length] ** 2) / noise)
+
+
+def compare_quantized(
+    input_path: str,
+    count=16,
+    models=(config.UVR_FIRST_MODEL, config.UVR_SECOND_MODEL),
+):
+    """
+    Separates a sample of files with the full and the quantized models on CPU
+    and reports the speed-up and SNR of the quantized stems against the full ones.
+    Every model gets the same input, so dereverb is compared on full mixes.
+    """
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+    files = sorted(find_files(input_path, ".wav"))[:count]
+    if len(files) == 0:
+        tqdm.write("No files to compare.")
+        return
+
+    for model in models:
+        stems = {}
+        elapsed = {}
+
+        for quantize in (False, True):
+            worker = UVRProcess({}, SimpleQueue(), [model], quantize=quantize)
+            worker.load_models()
+            if quantize and model not in worker.quantized:
+                break
+            # Warm up
+            worker._separate(model, input_path, None, files[0])
+
+            start = time.monotonic()
+            stems[quantize] = [
+                worker._separate(model, input_path, None, file) for file in files
+            ]
+            elapsed[quantize] = time.monotonic() - start
+
+        if True not in elapsed:
+            tqdm.write(f"{model}: nothing to quantize, it runs in float32 either way.")
+            continue
+
+        tqdm.write(
+            f"{model}: {elapsed[False] / len(files):.2f}s -> "
+            + f"{elapsed[True] / len(files):.2f}s per file "
+            + f"({elapsed[False] / elapsed[True]:.2f}x faster)"
+        )
+
+        for suffix in stems[False][0]:
+            snrs = sorted(
+                _snr(full[suffix], quantized[suffix])
+                for full, quantized in zip(stems[False], stems[True])
+            )
+            tqdm.write(
+                f"  {suffix}: SNR mean {sum(snrs) / len(snrs):.1f} dB, "
+                + f"worst {snrs[0]:.1f} dB"
+            )
@@ -3,7 +3,49 @@ import os
 
 from tqdm import tqdm
 
+import lib.ffmpeg as ffmpeg
 from util import Parallel, SubprocessException, spawn
+from util.dirty import line_key
+
+
+async def decode_to_wav(source: str, output: str):
+    """Converts game audio file straight to the format of `ffmpeg.to_wav`"""
+    read_fd, write_fd = os.pipe()
+    process = None
+
+    try:
+        process = await spawn(
+            "vgmstream",
+            "./libs/vgmstream/vgmstream-cli",
+            "-i",
+            "-p",
+            os.path.abspath(source),
+            stdout=write_fd,
+        )
+        # Only vgmstream may hold the writing end, so FFmpeg gets EOF
+        os.close(write_fd)
+        write_fd = None
+
+        await ffmpeg.to_wav("-", os.path.abspath(output), stdin=read_fd)
+    except BaseException:
+        # Nobody reads the pipe anymore, don't leave vgmstream blocked on it
+        if process is not None and process.returncode is None:
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+        raise
+    finally:
+        os.close(read_fd)
+        if write_fd is not None:
+            os.close(write_fd)
+        if process is not None:
+            result = await process.wait()
+
+    if result != 0:
+        raise SubprocessException(
+            f"Converting file {source} failed with exit code {result}"
+        )
 
 
 async def decode(source: str, output: str):
@@ -25,8 +67,13 @@ async def decode(source: str, output: str):
         )
 
 
-async def decode_all(input_path: str, output_path: str):
-    """Converts all .wem files to .wav files"""
+async def decode_all(
+    input_path: str, output_path: str, only: set[str] = None, uvr_format=False
+):
+    """
+    Converts all .wem files to .wav files, optionally only of given lines.
+    With `uvr_format`, the files are output in the format `isolate_vocals` expects.
+    """
     parallel = Parallel("Exporting .wem files")
 
     async def process(path: str, name: str):
@@ -34,7 +81,10 @@ async def decode_all(input_path: str, output_path: str):
         output_file = os.path.join(output_path, path, name[: -len(".wem")])
 
         try:
-            await decode(input_file, output_file + ".wav")
+            if uvr_format:
+                await decode_to_wav(input_file, output_file + ".wav")
+            else:
+                await decode(input_file, output_file + ".wav")
         except SubprocessException:
             tqdm.write(f"Converting {name} failed, continuing...")
 
@@ -43,8 +93,12 @@ async def decode_all(input_path: str, output_path: str):
         os.makedirs(os.path.join(output_path, path), exist_ok=True)
 
         for name in files:
-            if name.endswith(".wem"):
-                parallel.run(process, path, name)
+            if not name.endswith(".wem"):
+                continue
+            if only is not None and line_key(os.path.join(path, name)) not in only:
+                continue
+
+            parallel.run(process, path, name)
 
     await parallel.wait()
     tqdm.write("Exporting done!")
@@ -1,65 +1,251 @@
 import asyncio
 import os
 import re
+import shutil
+import tempfile
 from itertools import chain
 
 from tqdm import tqdm
 
+import config
 from config import WOLVENKIT_EXE
+from lib import archive
 from util import SubprocessException, spawn
 
 
-def _get_nonmod_folders():
-    game_path = os.getenv("CYBERPUNK_PATH")
+def _get_device_concurrency():
+    """
+    Parses WOLVENKIT_JOBS, either a number of concurrent WolvenKit processes per drive
+    or a comma separated list of `path=number` to set it for the drive of each path.
+    """
+    concurrency = {None: config.WOLVENKIT_JOBS}
 
-    # Find folders that arent mod
-    folders = []
-    for folder in os.listdir(game_path + "/archive/pc"):
-        if folder != "mod":
-            folders.append(f"{game_path}/archive/pc/{folder}")
+    for item in (os.getenv("WOLVENKIT_JOBS") or "").split(","):
+        item = item.strip()
+        if item == "":
+            continue
 
-    return folders
+        path, _, jobs = item.rpartition("=")
+        if path == "":
+            concurrency[None] = int(jobs)
+        else:
+            concurrency[os.stat(path).st_dev] = int(jobs)
 
+    return concurrency
 
-async def extract_files(pattern: str, output_path: str, log=True):
-    """Extracts files from the game matching the given pattern."""
 
-    tqdm.write("Starting WolvenKit unbundle...")
+def _group_archives(archives: list[str]):
+    """Splits archives into balanced groups, as many per drive as it can handle."""
+    concurrency = _get_device_concurrency()
 
+    by_device = {}
+    for path in archives:
+        by_device.setdefault(os.stat(path).st_dev, []).append(path)
+
+    groups = []
+    for device, paths in by_device.items():
+        jobs = max(1, concurrency.get(device, concurrency[None]))
+        device_groups = [[] for _ in range(min(jobs, len(paths)))]
+        sizes = [0] * len(device_groups)
+
+        # Biggest first into the smallest group
+        for path in sorted(paths, key=os.path.getsize, reverse=True):
+            i = sizes.index(min(sizes))
+            device_groups[i].append(path)
+            sizes[i] += os.path.getsize(path)
+
+        groups.extend((device, group) for group in device_groups)
+
+    return groups, concurrency
+
+
+def _merge_tree(source: str, target: str):
+    """Moves all files from source to target, overwriting existing."""
+    for root, _dirs, files in os.walk(source):
+        target_root = os.path.join(target, root[len(source) + 1 :])
+        os.makedirs(target_root, exist_ok=True)
+
+        for file in files:
+            os.replace(os.path.join(root, file), os.path.join(target_root, file))
+
+
+async def _unbundle(archives: list[str], output_path: str, *args, log=True):
+    """Runs WolvenKit unbundle over given archives in concurrent processes."""
+    groups, concurrency = _group_archives(archives)
+    semaphores = {
+        device: asyncio.Semaphore(max(1, concurrency.get(device, concurrency[None])))
+        for device, _group in groups
+    }
+
+    parts_path = re.sub(r"[\\/]+$", "", output_path) + ".parts"
+    shutil.rmtree(parts_path, ignore_errors=True)
+
+    pbar = tqdm(total=len(groups), desc="Unbundling archive groups", unit="group")
+
+    async def run(i: int, device: int, group: list[str]):
+        async with semaphores[device]:
+            result = await _wolvenkit(
+                "unbundle",
+                group,
+                *("-o", os.path.join(parts_path, str(i))),
+                *args,
+                log=log,
+            )
+        pbar.update(1)
+        return result
+
+    try:
+        results = await asyncio.gather(
+            *(run(i, device, group) for i, (device, group) in enumerate(groups))
+        )
+        pbar.close()
+
+        for result in results:
+            if result != 0:
+                return result
+
+        # All went well, move the results to their place
+        for i in range(len(groups)):
+            _merge_tree(os.path.join(parts_path, str(i)), output_path)
+
+        return 0
+    finally:
+        shutil.rmtree(parts_path, ignore_errors=True)
+
+
+def _write_hash_list(entries: list[archive.ArchiveEntry]):
+    """Writes hashes of given entries to a file WolvenKit can read."""
+    os.makedirs(config.TMP_PATH, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", suffix=".txt", dir=config.TMP_PATH, delete=False, encoding="utf-8"
+    ) as f:
+        f.write("\n".join(str(entry.hash) for entry in entries))
+    return os.path.abspath(f.name)
+
+
+def _get_entry_archives(entries: list[archive.ArchiveEntry]):
+    return sorted(set(entry.archive for entry in entries))
+
+
+async def _wolvenkit(command: str, paths: list[str], *args, log=True):
     process = await spawn(
         "WolvenKit",
         WOLVENKIT_EXE,
-        "unbundle",
-        *_get_nonmod_folders(),
+        command,
+        *paths,
         *("-gp", os.getenv("CYBERPUNK_PATH")),
-        *("-o", output_path),
-        *("-r", pattern),
+        *args,
         stdout=None if log else asyncio.subprocess.DEVNULL,
     )
-    result = await process.wait()
+    return await process.wait()
+
+
+async def extract_files(
+    pattern: str, output_path: str, log=True, manifest: str = None, delta=False
+):
+    """
+    Extracts files from the game matching the given pattern.
+    If manifest path is given, content hashes of the files are saved to it and
+    in delta mode only files that changed since the last extraction are extracted.
+    Returns changes against the manifest.
+    """
+
+    index = archive.get_index()
+    changes = None
+
+    if index is None:
+        if delta:
+            raise RuntimeError("Delta extraction needs the archive index.")
+        manifest = None
+
+        tqdm.write("Starting WolvenKit unbundle...")
+        result = await _unbundle(
+            archive.get_archives(os.getenv("CYBERPUNK_PATH")),
+            output_path,
+            *("-r", pattern),
+            log=log,
+        )
+    else:
+        entries = index.select(pattern)
+        selected = entries
+
+        if manifest is not None:
+            changes = archive.diff_manifest(archive.read_manifest(manifest), entries)
+
+            if delta:
+                tqdm.write(
+                    f"Game files changed: {len(changes.added)} added, "
+                    + f"{len(changes.changed)} changed, {len(changes.removed)} removed."
+                )
+                wanted = set(changes.added) | set(changes.changed)
+                selected = [entry for entry in entries if entry.path in wanted]
+
+                for path in changes.removed:
+                    file = os.path.join(output_path, *path.split("\\"))
+                    if os.path.exists(file):
+                        os.unlink(file)
+
+        tqdm.write(f"Found {len(selected)} matching files, extracting...")
+        rest = archive.extract_entries(selected, output_path)
+        result = 0
+
+        if len(rest) > 0:
+            tqdm.write(f"Starting WolvenKit unbundle for {len(rest)} packed files...")
+            hash_list = _write_hash_list(rest)
+            try:
+                result = await _unbundle(
+                    _get_entry_archives(rest),
+                    output_path,
+                    *("--hash", hash_list),
+                    log=log,
+                )
+            finally:
+                os.unlink(hash_list)
 
     if result != 0:
         raise SubprocessException("Extracting failed with exit code " + str(result))
+
+    if manifest is not None:
+        archive.write_manifest(manifest, entries)
+
     tqdm.write("Extracting done!")
+    return changes
 
 
 async def uncook_json(pattern: str, output_path: str, log=True):
     """Extract json files from the game matching the given pattern."""
 
+    index = archive.get_index()
+
     tqdm.write("Starting WolvenKit uncook...")
 
-    process = await spawn(
-        "WolvenKit",
-        WOLVENKIT_EXE,
-        "uncook",
-        *("-gp", os.getenv("CYBERPUNK_PATH")),
-        "-s",
-        "-u",
-        *("-r", pattern),
-        *("-o", output_path),
-        stdout=None if log else asyncio.subprocess.DEVNULL,
-    )
-    result = await process.wait()
+    hash_list = None
+    if index is None:
+        selection = ("-r", pattern)
+        paths = ()
+    else:
+        entries = index.select(pattern)
+        if len(entries) == 0:
+            tqdm.write("No files match the pattern.")
+            return
+
+        hash_list = _write_hash_list(entries)
+        selection = ("--hash", hash_list)
+        paths = _get_entry_archives(entries)
+
+    try:
+        result = await _wolvenkit(
+            "uncook",
+            paths,
+            "-s",
+            "-u",
+            *selection,
+            *("-o", output_path),
+            log=log,
+        )
+    finally:
+        if hash_list is not None:
+            os.unlink(hash_list)
 
     if result != 0:
         raise SubprocessException("Uncooking failed with exit code " + str(result))
@@ -8,6 +8,7 @@ from tqdm import tqdm
 from waapi import CannotConnectToWaapiException, WaapiClient, WaapiRequestFailed
 
 from util import SubprocessException, spawn, watch_async
+from util.dirty import line_key
 
 nest_asyncio.apply()  # needed for waapi
 
@@ -189,7 +190,12 @@ def move_wwise_files_auto(project_dir: str, output_path: str):
 
 
 async def _convert_files(
-    input_path: str, project_dir: str, output_path: str, override: bool, waapi
+    input_path: str,
+    project_dir: str,
+    output_path: str,
+    override: bool,
+    waapi,
+    only: set[str] = None,
 ):
     # Wait for load
     await wait_waapi_load(waapi)
@@ -213,6 +219,9 @@ async def _convert_files(
                 continue
 
             file_path = os.path.join(relative_root, file)
+            if only is not None and line_key(file_path) not in only:
+                continue
+
             if not override and os.path.exists(
                 os.path.join(output_path, re.sub(r"\.wav$", ".wem", file_path))
             ):
@@ -327,9 +336,13 @@ async def _convert_files(
 
 
 async def convert_files(
-    input_path: str, project_dir: str, output_path: str, override: bool
+    input_path: str,
+    project_dir: str,
+    output_path: str,
+    override: bool,
+    only: set[str] = None,
 ):
-    """Converts all files in the given folder to Wwise format."""
+    """Converts all files in the given folder to Wwise format, optionally only given lines."""
     await create_project(project_dir)
 
     tqdm.write("##############################################################")
@@ -349,7 +362,9 @@ async def convert_files(
 
     # Run the script
     try:
-        await _convert_files(input_path, project_dir, output_path, override, waapi)
+        await _convert_files(
+            input_path, project_dir, output_path, override, waapi, only
+        )
     finally:
         # Close the WAAPI server
         if server.returncode is None:
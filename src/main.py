@@ -12,8 +12,11 @@ import config
 import util
 from args import main as parser
 from lib import (
+    autotune,
     ffmpeg,
     opustoolz,
+    pack,
+    preview,
     rvc,
     sfx_mapping,
     tts,
@@ -23,10 +26,31 @@ from lib import (
     wwise,
     wwiser,
 )
+from util import dirty
 
 load_dotenv(".env")
 
 
+def _take_dirty(args: Namespace, phase: str, *outputs: str):
+    """Returns lines the phase should process, None for all, and removes outputs of removed lines."""
+    if not args.dirty:
+        return None
+
+    changed, removed = dirty.DirtyLines().get(phase)
+    for output in outputs:
+        dirty.remove_outputs(output, removed)
+
+    tqdm.write(
+        f"Processing {len(changed)} changed lines, removed {len(removed)} lines."
+    )
+    return changed
+
+
+def _clear_dirty(args: Namespace, phase: str):
+    if args.dirty:
+        dirty.DirtyLines().clear(phase)
+
+
 async def sfx_metadata(args: Namespace):
     """Extracts SFX metadata from the game."""
 
@@ -242,17 +266,97 @@ async def extract_files(args: Namespace):
     """Extracts files from the game matching the given pattern."""
 
     pattern = f"\\\\{args.pattern}\\.wem$"
-    await wolvenkit.extract_files(pattern, args.output)
+    changes = await wolvenkit.extract_files(
+        pattern,
+        args.output,
+        manifest=os.path.join(args.output, config.EXTRACT_MANIFEST),
+        delta=args.delta,
+    )
+
+    if args.delta:
+        dirty.DirtyLines().mark(changes.added + changes.changed, changes.removed)
+        tqdm.write(
+            "Run the following phases with --dirty to process only changed lines."
+        )
 
 
 async def export_wem(args: Namespace):
     """Converts all cached .wem files to a usable format."""
-    await vgmstream.decode_all(args.input, args.output)
+    only = _take_dirty(args, "export_wem", args.output)
+    await vgmstream.decode_all(args.input, args.output, only, args.uvr_format)
+    _clear_dirty(args, "export_wem")
 
 
 async def isolate_vocals(args: Namespace):
     """Splits audio files to vocals and the rest."""
-    await uvr.isolate_vocals(args.input, args.cache, args.overwrite, args.batchsize)
+    only = _take_dirty(
+        args,
+        "isolate_vocals",
+        *(
+            os.path.join(args.cache, path)
+            for path in (
+                config.UVR_FORMAT_CACHE,
+                config.UVR_FIRST_CACHE,
+                config.UVR_SECOND_CACHE,
+            )
+        ),
+    )
+    reverb_path = os.path.join(args.cache, config.UVR_SECOND_CACHE)
+    uvr.mark_done(reverb_path, False)
+    try:
+        await uvr.isolate_vocals(
+            args.input,
+            args.cache,
+            args.overwrite or only is not None,
+            args.batchsize,
+            only,
+            args.in_memory,
+            args.clip_batch,
+            args.quantize,
+        )
+    finally:
+        # Lets `revoice --follow` finish even if this failed
+        uvr.mark_done(reverb_path)
+    _clear_dirty(args, "isolate_vocals")
+
+
+async def benchmark_uvr(args: Namespace):
+    """Measures UVR throughput for different batch sizes."""
+    uvr.benchmark_batching(args.input, args.sizes, args.count, args.model)
+
+
+async def compare_quantized(args: Namespace):
+    """Compares quantized UVR models with the full ones."""
+    uvr.compare_quantized(args.input, args.count)
+
+
+async def autotune_phase(args: Namespace):
+    """Finds the fastest settings for a phase."""
+    candidates = autotune.get_candidates(
+        args.workers, args.threads, args.interop_threads
+    )
+
+    if args.target == "uvr":
+        await autotune.tune_uvr(
+            args.input or os.path.join(config.CACHE_PATH, config.UVR_FORMAT_CACHE),
+            args.sample,
+            candidates,
+        )
+        return
+
+    if args.model_name is None:
+        raise ValueError("--model_name is required to tune RVC.")
+
+    await autotune.tune_rvc(
+        args.input or os.path.join(config.CACHE_PATH, config.UVR_SECOND_CACHE),
+        args.sample,
+        candidates,
+        ".wav" + config.UVR_SECOND_SUFFIX,
+        model_name=args.model_name,
+        index_path=args.index_path,
+        f0method=args.f0method,
+        device=args.device,
+    )
 
 
 async def export_subtitle_map(args: Namespace):
@@ -320,7 +424,41 @@ async def revoice(args: Namespace):
     """Run RVC over given folder."""
     rest_args = dict(args.__dict__)
     del rest_args["subcommand"]
+    del rest_args["dirty"]
+
+    if args.sweep is not None:
+        del rest_args["opt_path"]
+        del rest_args["overwrite"]
+        del rest_args["follow"]
+        await rvc.sweep_rvc(**rest_args)
+        return
+
+    only = _take_dirty(args, "revoice", args.opt_path)
+    if only is not None:
+        rest_args["overwrite"] = True
+        rest_args["files"] = [
+            file
+            for file in util.find_files(args.input_path, args.suffix)
+            if dirty.line_key(file) in only
+        ]
+
     await rvc.batch_rvc(**rest_args)
+    _clear_dirty(args, "revoice")
+
+
+async def rvc_server(args: Namespace):
+    """Runs the RVC server, or stops it."""
+    if args.stop:
+        await rvc.stop_server()
+        return
+
+    await rvc.run_server(
+        batchsize=args.batchsize,
+        num_threads=args.num_threads,
+        interop_threads=args.interop_threads,
+        models=args.models,
+        cpu_profile=args.cpu_profile,
+    )
 
 
 async def revoice_sfx(args: Namespace):
@@ -331,41 +469,119 @@ async def revoice_sfx(args: Namespace):
     del rest_args["subcommand"]
     del rest_args["gender"]
     del rest_args["input_path"]
+    del rest_args["dirty"]
     await rvc.batch_rvc(input_path, **rest_args)
 
 
+def _merge_inputs(voice_path: str, voice_vol: float, cache: str, effect_vol: float):
+    return [
+        # Voice
+        ffmpeg.InputItem(
+            voice_path,
+            voice_vol,
+            ".wav" + config.UVR_SECOND_SUFFIX,
+            normalize=True,
+        ),
+        # Instrumentals
+        ffmpeg.InputItem(
+            os.path.join(cache, config.UVR_FIRST_CACHE),
+            effect_vol,
+            ".wav" + config.UVR_FIRST_SUFFIX_O,
+            optional=True,
+        ),
+        # Reverb
+        ffmpeg.InputItem(
+            os.path.join(cache, config.UVR_SECOND_CACHE),
+            effect_vol,
+            ".wav" + config.UVR_SECOND_SUFFIX_O,
+            optional=True,
+        ),
+    ]
+
+
 async def merge_vocals(args: Namespace):
     """Merge vocals with effects."""
+    only = _take_dirty(args, "merge_vocals", args.output_path)
     await ffmpeg.merge(
-        [
-            # Voice
-            ffmpeg.InputItem(
-                args.voice_path,
-                args.voice_vol,
-                ".wav" + config.UVR_SECOND_SUFFIX,
-                normalize=True,
-            ),
-            # Instrumentals
-            ffmpeg.InputItem(
-                os.path.join(args.effect_cache, config.UVR_FIRST_CACHE),
-                args.effect_vol,
-                ".wav" + config.UVR_FIRST_SUFFIX_O,
-                optional=True,
-            ),
-            # Reverb
-            ffmpeg.InputItem(
-                os.path.join(args.effect_cache, config.UVR_SECOND_CACHE),
-                args.effect_vol,
-                ".wav" + config.UVR_SECOND_SUFFIX_O,
-                optional=True,
-            ),
-        ],
+        _merge_inputs(
+            args.voice_path, args.voice_vol, args.effect_cache, args.effect_vol
+        ),
         args.output_path,
         args.format,
-        args.overwrite,
+        args.overwrite or only is not None,
         args.filter_complex,
+        only,
+    )
+    _clear_dirty(args, "merge_vocals")
+
+
+async def preview_phase(args: Namespace):
+    """Runs a representative sample of lines through the whole chain."""
+    picked = await preview.pick_lines(args.input, args.count)
+    if len(picked) == 0:
+        tqdm.write("No files to preview.")
+        return
+
+    only = set(dirty.line_key(file) for file, _ in picked)
+    tqdm.write(f"Previewing {len(only)} lines...")
+
+    # Already isolated lines are reused
+    await uvr.isolate_vocals(args.input, config.CACHE_PATH, False, only=only)
+
+    shutil.rmtree(args.output, ignore_errors=True)
+    voiced_path = os.path.join(args.output, "voiced")
+    merged_path = os.path.join(args.output, "merged")
+
+    rest_args = dict(args.__dict__)
+    for key in (
+        "subcommand",
+        "dirty",
+        "input",
+        "output",
+        "input_path",
+        "opt_path",
+        "overwrite",
+        "suffix",
+        "count",
+        "voice_vol",
+        "effect_vol",
+        "sweep",
+        "sweep_sample",
+        "sweep_path",
+        "benchmark_batch",
+        "benchmark_index",
+    ):
+        del rest_args[key]
+
+    await rvc.batch_rvc(
+        os.path.join(config.CACHE_PATH, config.UVR_SECOND_CACHE),
+        voiced_path,
+        True,
+        [
+            os.path.splitext(file)[0] + ".wav" + config.UVR_SECOND_SUFFIX
+            for file, _ in picked
+        ],
+        **rest_args,
+    )
+    await ffmpeg.merge(
+        _merge_inputs(voiced_path, args.voice_vol, config.CACHE_PATH, args.effect_vol),
+        merged_path,
+        only=only,
     )
 
+    playlist = os.path.join(args.output, "preview.m3u")
+    preview.write_playlist(
+        playlist,
+        [
+            (os.path.join("merged", os.path.splitext(file)[0] + ".wav"), probe)
+            for file, probe in picked
+            if os.path.exists(
+                os.path.join(merged_path, os.path.splitext(file)[0] + ".wav")
+            )
+        ],
+    )
+    tqdm.write(f"Done, listen to {playlist}")
+
 
 async def revoice_silent(args: Namespace):
     """Try to revoice files that came out silent."""
@@ -390,6 +606,7 @@ async def revoice_silent(args: Namespace):
     del rest_args["input_suffix"]
     del rest_args["input"]
     rest_args["input_path"] = tmp_path
+    rest_args["dirty"] = False
 
     await revoice(Namespace(**rest_args))
     shutil.rmtree(tmp_path)
@@ -397,7 +614,11 @@ async def revoice_silent(args: Namespace):
 
 async def wwise_import(args: Namespace):
     """Import all found audio files to Wwise and runs conversion."""
-    await wwise.convert_files(args.input, args.project, args.output, args.overwrite)
+    only = _take_dirty(args, "wwise", args.output)
+    await wwise.convert_files(
+        args.input, args.project, args.output, args.overwrite or only is not None, only
+    )
+    _clear_dirty(args, "wwise")
 
 
 async def move_wwise_files(args: Namespace):
@@ -412,7 +633,24 @@ async def pack_opuspaks(args: Namespace):
 
 async def pack_files(args: Namespace):
     """Pack given folder into a .archive"""
-    await wolvenkit.pack_files(args.archive, args.folder, args.output)
+    if args.incremental:
+        await pack.pack_incremental(
+            args.archive, args.folder, args.output, native=args.native
+        )
+    elif args.native:
+        pack.pack_native(args.archive, args.folder, args.output)
+    else:
+        await wolvenkit.pack_files(args.archive, args.folder, args.output)
+
+
+async def verify_pack(args: Namespace):
+    """Compares native packing with WolvenKit."""
+    differences = await pack.verify_native_pack(args.folder)
+    for difference in differences:
+        tqdm.write(difference)
+
+    if len(differences) > 0:
+        raise RuntimeError("Native archive differs from WolvenKit's!")
 
 
 async def zip_files(args: Namespace):
@@ -440,16 +678,22 @@ async def _main():
         "extract": extract_files,
         "export_wem": export_wem,
         "isolate_vocals": isolate_vocals,
+        "benchmark_uvr": benchmark_uvr,
+        "compare_quantized": compare_quantized,
+        "autotune": autotune_phase,
         "map_subtitles": export_subtitle_map,
         "tts": do_tts,
         "revoice": revoice,
         "revoice_sfx": revoice_sfx,
+        "rvc_server": rvc_server,
         "merge_vocals": merge_vocals,
+        "preview": preview_phase,
         "revoice_silent": revoice_silent,
         "wwise": wwise_import,
         "move_wwise_files": move_wwise_files,
         "pack_opuspaks": pack_opuspaks,
         "pack": pack_files,
+        "verify_pack": verify_pack,
         "zip": zip_files,
     }.get(args.subcommand, main_default)(args)
 
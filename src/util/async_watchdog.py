@@ -5,19 +5,24 @@ from watchdog.observers import Observer
 
 
 class _EventHandler(FileSystemEventHandler):
-    def __init__(self, queue: asyncio.Queue, *args, **kwargs):
+    def __init__(self, queue: asyncio.Queue, moves: bool, *args, **kwargs):
         self.__queue = queue
+        self.__moves = moves
         super().__init__(*args, **kwargs)
 
     def on_created(self, event: FileSystemEvent) -> None:
         self.__queue.put_nowait(event)
 
+    def on_moved(self, event: FileSystemEvent) -> None:
+        if self.__moves:
+            self.__queue.put_nowait(event)
 
-def watch_async(path: str, recursive: bool = False):
-    """Watch a directory for changes."""
+
+def watch_async(path: str, recursive: bool = False, moves: bool = False):
+    """Watch a directory for changes, optionally also for files moved into it."""
     queue = asyncio.Queue()
 
-    handler = _EventHandler(queue)
+    handler = _EventHandler(queue, moves)
 
     observer = Observer()
     observer.schedule(handler, path, recursive=recursive)
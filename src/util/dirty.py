@@ -0,0 +1,87 @@
+import json
+import os
+import re
+
+import config
+
+PHASES = ("export_wem", "isolate_vocals", "revoice", "merge_vocals", "wwise")
+
+
+def line_key(path: str):
+    """Returns the voiceline a file belongs to, e.g. `base/vo/v_xyz` for any of its stems."""
+    path = re.sub(r"[\\/]+", "/", path).strip("/")
+    dirname, _, basename = path.rpartition("/")
+    basename = basename.split(".", 1)[0]
+    return f"{dirname}/{basename}" if dirname else basename
+
+
+class DirtyLines:
+    """Voicelines that changed since the last run of each phase."""
+
+    __path: str
+    __phases: dict[str, dict[str, set]]
+
+    def __init__(self, path: str = config.DIRTY_PATH):
+        self.__path = path
+        self.__phases = {}
+
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for phase, lines in json.load(f).items():
+                    self.__phases[phase] = {k: set(v) for k, v in lines.items()}
+        except (IOError, ValueError):
+            pass
+
+    def __get(self, phase: str):
+        return self.__phases.setdefault(phase, {"changed": set(), "removed": set()})
+
+    def mark(self, changed: list[str], removed: list[str]):
+        """Marks given lines dirty for all phases."""
+        changed = set(map(line_key, changed))
+        removed = set(map(line_key, removed))
+
+        for phase in PHASES:
+            lines = self.__get(phase)
+            lines["changed"] = (lines["changed"] - removed) | changed
+            lines["removed"] = (lines["removed"] - changed) | removed
+
+        self.save()
+
+    def get(self, phase: str):
+        """Returns changed and removed lines for given phase."""
+        lines = self.__get(phase)
+        return set(lines["changed"]), set(lines["removed"])
+
+    def clear(self, phase: str):
+        """Marks given phase as done."""
+        self.__phases.pop(phase, None)
+        self.save()
+
+    def save(self):
+        """Writes the dirty lines to disk."""
+        os.makedirs(os.path.dirname(self.__path), exist_ok=True)
+        with open(self.__path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    phase: {k: sorted(v) for k, v in lines.items()}
+                    for phase, lines in self.__phases.items()
+                },
+                f,
+                indent=4,
+            )
+
+
+def remove_outputs(path: str, lines: set[str]):
+    """Deletes all files in given folder that belong to given lines."""
+    if len(lines) == 0:
+        return 0
+
+    removed = 0
+    for root, _dirs, files in os.walk(path):
+        relative_root = root[len(path) + 1 :]
+        for file in files:
+            if line_key(os.path.join(relative_root, file)) in lines:
+                os.unlink(os.path.join(root, file))
+                removed += 1
+
+    return removed
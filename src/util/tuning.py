@@ -0,0 +1,28 @@
+import json
+import os
+import platform
+
+import config
+
+
+def _read_tunings():
+    try:
+        with open(config.AUTOTUNE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def get_tuning(kind: str):
+    """Returns the best settings found by `autotune` for this machine, if any."""
+    return _read_tunings().get(platform.node(), {}).get(kind)
+
+
+def save_tuning(kind: str, settings: dict):
+    """Saves the best settings for this machine."""
+    tunings = _read_tunings()
+    tunings.setdefault(platform.node(), {})[kind] = settings
+
+    os.makedirs(os.path.dirname(config.AUTOTUNE_PATH), exist_ok=True)
+    with open(config.AUTOTUNE_PATH, "w", encoding="utf-8") as f:
+        json.dump(tunings, f, indent=4)